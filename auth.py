@@ -3,10 +3,18 @@ Authentication middleware for Supabase JWT validation.
 Provides role-based access control for API endpoints.
 """
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import jwt, JWTError
 from typing import Optional
+from functools import lru_cache
+from cachetools import TTLCache
+import asyncio
+import hashlib
 import httpx
+import orjson
+import redis.asyncio as aioredis
+import time
 
 from config import get_settings
 from schemas import UserProfile, UserRole
@@ -15,24 +23,52 @@ from supabase_client import get_supabase_client
 # Security scheme for Swagger UI
 security = HTTPBearer(auto_error=False)
 
-# Cache for JWKS
-_jwks_cache = None
+# Only the columns needed to build a UserProfile
+PROFILE_COLUMNS = "id,email,full_name,role,student_id"
+
+# Cache for JWKS as (keys, expires_at on the monotonic clock)
+_jwks_cache: Optional[tuple[dict, float]] = None
+_jwks_lock = asyncio.Lock()
+_JWKS_TTL_SECONDS = 3600
+
+# Shared client so JWKS refreshes reuse one connection pool
+_http = httpx.AsyncClient(timeout=5.0)
+
+# Verified profiles keyed by SHA-256 of the bearer token.
+# Entries hold (profile, exp) and live at most 30s, so role changes and
+# revocations propagate quickly while repeat requests skip decode + DB.
+_token_cache: TTLCache = TTLCache(maxsize=10000, ttl=30)
+
+# In-flight lookups keyed like _token_cache, so concurrent requests with
+# the same token share one verification while different tokens proceed
+# in parallel
+_token_pending: dict[bytes, asyncio.Task] = {}
+
+# Optional Redis tier so all uvicorn workers share verified tokens
+_redis_url = get_settings().REDIS_URL
+_redis = aioredis.from_url(_redis_url) if _redis_url else None
+_REDIS_TTL_SECONDS = 60
 
 
 async def get_jwks():
     """Fetch Supabase JWKS for token verification."""
     global _jwks_cache
-    if _jwks_cache is not None:
-        return _jwks_cache
-    
-    settings = get_settings()
-    jwks_url = f"{settings.SUPABASE_URL}/auth/v1/.well-known/jwks.json"
+    if _jwks_cache is not None and time.monotonic() < _jwks_cache[1]:
+        return _jwks_cache[0]
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(jwks_url)
+    async with _jwks_lock:
+        # Re-check in case a concurrent request already refreshed the keys
+        if _jwks_cache is not None and time.monotonic() < _jwks_cache[1]:
+            return _jwks_cache[0]
+        
+        settings = get_settings()
+        jwks_url = f"{settings.SUPABASE_URL}/auth/v1/.well-known/jwks.json"
+        
+        response = await _http.get(jwks_url)
         if response.status_code == 200:
-            _jwks_cache = response.json()
-            return _jwks_cache
+            jwks = response.json()
+            _jwks_cache = (jwks, time.monotonic() + _JWKS_TTL_SECONDS)
+            return jwks
     return None
 
 
@@ -49,9 +85,105 @@ async def get_current_user(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    token = credentials.credentials
-    settings = get_settings()
+    return await _resolve(credentials.credentials)
+
+
+async def _resolve(token: str) -> UserProfile:
+    """
+    Resolve a bearer token to a user profile, going through the token caches.
+    """
+    # A JWT is always header.payload.signature - reject anything else
+    # before doing any base64/JSON work
+    if token.count(".") != 2:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token: malformed JWT",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    key = hashlib.sha256(token.encode()).digest()
+    
+    cached = _token_cache.get(key)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    
+    task = _token_pending.get(key)
+    if task is None:
+        task = asyncio.create_task(_load_profile(key, token))
+        _token_pending[key] = task
+        task.add_done_callback(lambda _: _token_pending.pop(key, None))
+    
+    # Shielded so one cancelled request doesn't cancel the lookup for the
+    # others waiting on it
+    profile, _ = await asyncio.shield(task)
+    return profile
+
+
+async def _load_profile(key: bytes, token: str) -> tuple[UserProfile, float]:
+    """
+    Load a token's profile from Redis, or verify it, and cache the result.
+    
+    Returns:
+        Tuple of (profile, token expiry timestamp)
+    """
+    cached = await _get_shared_profile(key)
+    if cached is None:
+        cached = await _verify_token(token)
+        await _set_shared_profile(key, *cached)
+    _token_cache[key] = cached
+    return cached
+
+
+async def _get_shared_profile(key: bytes) -> Optional[tuple[UserProfile, float]]:
+    """
+    Look up a verified token in Redis, if configured.
+    
+    Returns:
+        Tuple of (profile, token expiry timestamp) or None on a miss
+    """
+    if _redis is None:
+        return None
     
+    try:
+        raw = await _redis.get(f"profile:{key.hex()}")
+    except Exception as e:
+        # Redis is only a cache - fall back to verifying the token
+        print(f"Error reading token cache: {e}")
+        return None
+    
+    if raw is None:
+        return None
+    
+    entry = orjson.loads(raw)
+    if entry["exp"] <= time.time():
+        return None
+    
+    return UserProfile.model_validate(entry["profile"]), entry["exp"]
+
+
+async def _set_shared_profile(key: bytes, profile: UserProfile, exp: float):
+    """Store a verified token in Redis, never past the token's own expiry."""
+    ttl = min(int(exp - time.time()), _REDIS_TTL_SECONDS)
+    if _redis is None or ttl <= 0:
+        return
+    
+    try:
+        await _redis.set(
+            f"profile:{key.hex()}",
+            orjson.dumps({"exp": exp, "profile": profile.model_dump(mode="json")}),
+            ex=ttl
+        )
+    except Exception as e:
+        print(f"Error writing token cache: {e}")
+
+
+async def _verify_token(token: str) -> tuple[UserProfile, float]:
+    """
+    Decode the token and load the matching profile.
+    
+    Returns:
+        Tuple of (profile, token expiry timestamp)
+    """
     try:
         # Decode without verification first to get claims
         # Supabase tokens use ES256, which requires public key verification
@@ -66,7 +198,6 @@ async def get_current_user(
             )
         
         # Check token expiration
-        import time
         exp = unverified_payload.get("exp", 0)
         if exp < time.time():
             raise HTTPException(
@@ -81,42 +212,55 @@ async def get_current_user(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Fetch user profile from database
+    # Fetch user profile from database (sync client, so keep it off the event loop)
     supabase = get_supabase_client()
-    result = supabase.table("profiles").select("*").eq("id", user_id).execute()
     
-    if not result.data:
+    def fetch_profile() -> Optional[dict]:
+        result = (
+            supabase.table("profiles")
+            .select(PROFILE_COLUMNS)
+            .eq("id", user_id)
+            .maybe_single()
+            .execute()
+        )
+        return result.data if result else None
+    
+    profile_data = await run_in_threadpool(fetch_profile)
+    
+    if not profile_data:
         # Profile doesn't exist - might need to be created
         # Let's try to create it from the token data
         email = unverified_payload.get("email")
         try:
-            supabase.table("profiles").insert({
-                "id": user_id,
-                "email": email,
-                "full_name": "",
-                "role": "student"  # Default role
-            }).execute()
+            await run_in_threadpool(
+                lambda: supabase.table("profiles").insert({
+                    "id": user_id,
+                    "email": email,
+                    "full_name": "",
+                    "role": "student"  # Default role
+                }).execute()
+            )
             
             # Fetch again
-            result = supabase.table("profiles").select("*").eq("id", user_id).execute()
+            profile_data = await run_in_threadpool(fetch_profile)
         except Exception:
             pass
     
-    if not result.data:
+    if not profile_data:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User profile not found. Please contact admin to set up your profile.",
         )
     
-    profile_data = result.data[0]
-    
-    return UserProfile(
+    profile = UserProfile(
         id=profile_data["id"],
         email=profile_data.get("email"),
         full_name=profile_data.get("full_name"),
-        role=UserRole(profile_data.get("role", "student")),
+        role=profile_data.get("role", "student"),
         student_id=profile_data.get("student_id"),
     )
+    
+    return profile, exp
 
 
 async def get_optional_user(
@@ -129,7 +273,7 @@ async def get_optional_user(
         return None
     
     try:
-        return await get_current_user(credentials)
+        return await _resolve(credentials.credentials)
     except HTTPException:
         return None
 
@@ -137,14 +281,25 @@ async def get_optional_user(
 def require_role(*allowed_roles: UserRole):
     """
     Dependency factory for role-based access control.
+    
+    The same set of roles always yields the same dependency, whatever
+    order the roles are given in.
     """
+    return _role_checker(frozenset(allowed_roles))
+
+
+@lru_cache(maxsize=16)
+def _role_checker(allowed_roles: frozenset[UserRole]):
+    """Build the dependency enforcing one set of roles."""
+    required = sorted(r.value for r in allowed_roles)
+    
     async def role_checker(
         user: UserProfile = Depends(get_current_user)
     ) -> UserProfile:
         if user.role not in allowed_roles:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
-                detail=f"Access denied. Required roles: {[r.value for r in allowed_roles]}. Your role: {user.role.value}",
+                detail=f"Access denied. Required roles: {required}. Your role: {user.role}",
             )
         return user
     
@@ -0,0 +1,73 @@
+"""
+In-process response cache for hot read endpoints.
+"""
+from fastapi import Request, Response, status
+from typing import Any, Hashable, Optional
+from cachetools import TTLCache
+import hashlib
+
+
+# Responses keyed by (table, exam_id, *query_params). Entries live at most
+# 30s, and writes evict the affected keys straight away.
+response_cache: TTLCache = TTLCache(maxsize=1024, ttl=30)
+
+
+def get_cached(table: str, exam_id: Optional[str], *params: Hashable) -> Any:
+    """
+    Get a cached response.
+
+    Returns:
+        The cached value or None on a miss
+    """
+    return response_cache.get((table, exam_id, *params))
+
+
+def set_cached(value: Any, table: str, exam_id: Optional[str], *params: Hashable) -> Any:
+    """Cache a response and return it."""
+    response_cache[(table, exam_id, *params)] = value
+    return value
+
+
+def invalidate(table: str, exam_id: Optional[str] = None):
+    """
+    Evict cached responses read from a table.
+
+    Args:
+        table: The table that was written to
+        exam_id: Only evict entries for this exam (plus cross-exam listings
+            keyed with exam_id None). Evicts the whole table if omitted.
+    """
+    for key in list(response_cache):
+        if key[0] == table and (exam_id is None or key[1] in (exam_id, None)):
+            response_cache.pop(key, None)
+
+
+def check_etag(
+    request: Request,
+    response: Response,
+    row_id: str,
+    updated_at: Any
+) -> Optional[Response]:
+    """
+    Tag a single-row response with a weak ETag built from the row version.
+    
+    Args:
+        request: The incoming request, checked for If-None-Match
+        response: The handler's response, which gets the ETag headers
+        row_id: The row's primary key
+        updated_at: The row's updated_at timestamp
+        
+    Returns:
+        A 304 response if the client already has this version, else None
+    """
+    digest = hashlib.blake2b(f"{row_id}:{updated_at}".encode(), digest_size=8).hexdigest()
+    headers = {"ETag": f'W/"{digest}"', "Cache-Control": "private, max-age=30"}
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip() for tag in if_none_match.split(",")}
+        if headers["ETag"] in tags or "*" in tags:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    response.headers.update(headers)
+    return None
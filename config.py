@@ -4,6 +4,7 @@ Loads environment variables from .env file.
 """
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import Optional
 
 
 class Settings(BaseSettings):
@@ -17,6 +18,9 @@ class Settings(BaseSettings):
     SUPABASE_ANON_KEY: str
     SUPABASE_SERVICE_KEY: str
     
+    # Redis (optional) - shares verified auth tokens across workers
+    REDIS_URL: Optional[str] = None
+    
     # App settings
     APP_NAME: str = "Exam Grading System"
     DEBUG: bool = False
@@ -24,9 +28,15 @@ class Settings(BaseSettings):
     # Gemini model
     GEMINI_MODEL: str = "gemini-2.5-pro-preview-05-06"
     
+    # Max answer sheets evaluated concurrently per job
+    EVALUATION_CONCURRENCY: int = 8
+    
     # Storage bucket name
     STORAGE_BUCKET: str = "answer-sheets"
     
+    # Largest answer sheet PDF accepted for upload
+    MAX_UPLOAD_MB: int = 20
+    
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
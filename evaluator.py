@@ -2,19 +2,19 @@
 Background evaluation worker for async exam grading.
 """
 import asyncio
+import time
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
+from postgrest.exceptions import APIError
 
-from supabase_client import get_supabase_client
+from config import get_settings
+from supabase_client import get_supabase_client, FOREIGN_KEY_VIOLATION
 from storage import download_pdf
-from gemini_client import evaluate_full_answer_sheet
-from schemas import Question, QuestionBreakdown
+from gemini_client import evaluate_full_answer_sheet, build_sheet_prompt
+from schemas import Question, QUESTIONS_ADAPTER
+from cache import invalidate
 
 
-# Thread pool for background processing
-executor = ThreadPoolExecutor(max_workers=3)
-
 # Track running jobs
 running_jobs: dict[str, asyncio.Task] = {}
 
@@ -31,34 +31,43 @@ async def start_evaluation(exam_id: str) -> str:
     """
     supabase = get_supabase_client()
     
-    # Check if exam exists and has answer key
-    exam_result = supabase.table("exams").select("*").eq("exam_id", exam_id).execute()
-    if not exam_result.data:
-        raise ValueError(f"Exam {exam_id} not found")
+    # Check the exam has an answer key and count its answer sheets - the
+    # lookups are independent, so run them together. The exam itself
+    # needs no lookup: the job insert below fails its foreign key if the
+    # exam doesn't exist.
+    answer_key_result, sheets_result = await asyncio.gather(
+        asyncio.to_thread(supabase.table("answer_keys").select("id").eq("exam_id", exam_id).limit(1).maybe_single().execute),
+        asyncio.to_thread(supabase.table("answer_sheets").select("id").eq("exam_id", exam_id).execute)
+    )
     
-    answer_key_result = supabase.table("answer_keys").select("*").eq("exam_id", exam_id).execute()
-    if not answer_key_result.data:
+    if not answer_key_result:
         raise ValueError(f"Answer key not found for exam {exam_id}")
     
-    # Get count of answer sheets
-    sheets_result = supabase.table("answer_sheets").select("id").eq("exam_id", exam_id).execute()
     total_sheets = len(sheets_result.data)
     
     if total_sheets == 0:
         raise ValueError(f"No answer sheets uploaded for exam {exam_id}")
     
     # Create evaluation job record
-    job_result = supabase.table("evaluation_jobs").insert({
-        "exam_id": exam_id,
-        "status": "pending",
-        "total_sheets": total_sheets,
-        "processed_sheets": 0
-    }).execute()
+    try:
+        job_result = await asyncio.to_thread(
+            supabase.table("evaluation_jobs").insert({
+                "exam_id": exam_id,
+                "status": "pending",
+                "total_sheets": total_sheets,
+                "processed_sheets": 0
+            }).execute
+        )
+    except APIError as e:
+        if e.code == FOREIGN_KEY_VIOLATION:
+            raise ValueError(f"Exam {exam_id} not found")
+        raise
     
     job_id = job_result.data[0]["id"]
     
     # Update exam status
-    supabase.table("exams").update({"status": "evaluating"}).eq("exam_id", exam_id).execute()
+    await asyncio.to_thread(supabase.table("exams").update({"status": "evaluating"}).eq("exam_id", exam_id).execute)
+    invalidate("exams", exam_id)
     
     # Start background task
     task = asyncio.create_task(process_evaluation(job_id, exam_id))
@@ -67,6 +76,24 @@ async def start_evaluation(exam_id: str) -> str:
     return job_id
 
 
+def get_answer_key_questions(exam_id: str) -> tuple[Question, ...]:
+    """
+    Load and validate the answer key questions for an exam.
+    
+    Not cached: it runs once per job, and a per-process cache would let
+    other workers grade with a stale rubric after the key changes.
+    
+    Args:
+        exam_id: The exam ID
+        
+    Returns:
+        Tuple of questions with rubrics
+    """
+    supabase = get_supabase_client()
+    answer_key_result = supabase.table("answer_keys").select("questions").eq("exam_id", exam_id).limit(1).single().execute()
+    return QUESTIONS_ADAPTER.validate_python(answer_key_result.data["questions"])
+
+
 async def process_evaluation(job_id: str, exam_id: str):
     """
     Process evaluation for all answer sheets in an exam.
@@ -78,112 +105,93 @@ async def process_evaluation(job_id: str, exam_id: str):
     supabase = get_supabase_client()
     
     try:
-        # Update job status to in_progress
-        supabase.table("evaluation_jobs").update({
-            "status": "in_progress",
-            "started_at": datetime.utcnow().isoformat()
-        }).eq("id", job_id).execute()
+        # Mark the job in_progress while fetching the answer key and all
+        # unprocessed answer sheets - none of these depend on each other
+        _, questions, sheets_result = await asyncio.gather(
+            asyncio.to_thread(
+                supabase.table("evaluation_jobs").update({
+                    "status": "in_progress",
+                    "started_at": datetime.utcnow().isoformat()
+                }).eq("id", job_id).execute
+            ),
+            asyncio.to_thread(get_answer_key_questions, exam_id),
+            asyncio.to_thread(supabase.table("answer_sheets").select("id,file_path").eq("exam_id", exam_id).eq("processed", False).execute)
+        )
+        questions = list(questions)
         
-        # Fetch answer key
-        answer_key_result = supabase.table("answer_keys").select("questions").eq("exam_id", exam_id).execute()
-        questions_data = answer_key_result.data[0]["questions"]
-        questions = [Question(**q) for q in questions_data]
+        # The prompt only depends on the answer key, so build it once per exam
+        prompt = build_sheet_prompt(questions)
         
-        # Fetch all unprocessed answer sheets
-        sheets_result = supabase.table("answer_sheets").select("*").eq("exam_id", exam_id).eq("processed", False).execute()
+        # Sheets are independent, so evaluate them concurrently up to the limit
+        settings = get_settings()
+        semaphore = asyncio.Semaphore(settings.EVALUATION_CONCURRENCY)
         
+        # Progress is written every ~2% of sheets or every 2 seconds rather
+        # than after every sheet, to avoid hammering the job row
+        flush_every = max(1, len(sheets_result.data) // 50)
         processed_count = 0
+        flushed_count = 0
+        last_flush = time.monotonic()
+        progress_lock = asyncio.Lock()
+        
+        async def flush_progress():
+            nonlocal flushed_count, last_flush
+            async with progress_lock:
+                # Skip if a flush queued ahead of us already wrote this count
+                if processed_count == flushed_count:
+                    return
+                flushed_count = processed_count
+                last_flush = time.monotonic()
+                await asyncio.to_thread(
+                    supabase.table("evaluation_jobs").update({
+                        "processed_sheets": flushed_count
+                    }).eq("id", job_id).execute
+                )
         
-        for sheet in sheets_result.data:
-            try:
-                # Download PDF
-                pdf_bytes = download_pdf(sheet["file_path"])
-                
-                # Evaluate with Gemini
-                student_id, breakdown = await evaluate_full_answer_sheet(pdf_bytes, questions)
-                
-                # Use extracted student ID or fallback to sheet ID
-                if not student_id:
-                    student_id = f"UNKNOWN_{sheet['id'][:8]}"
-                
-                # Calculate totals
-                total_marks = 0.0
-                max_marks = 0.0
-                has_illegible = False
-                
-                breakdown_dict = {}
-                for qid, result in breakdown.items():
-                    breakdown_dict[qid] = result.model_dump()
-                    max_marks += result.max
-                    if result.illegible:
-                        has_illegible = True
-                    elif result.awarded is not None:
-                        total_marks += result.awarded
-                
-                # Save result to database
-                supabase.table("results").upsert({
-                    "exam_id": exam_id,
-                    "student_id": student_id,
-                    "total_marks": total_marks,
-                    "max_marks": max_marks,
-                    "breakdown": breakdown_dict,
-                    "has_illegible": has_illegible,
-                    "reviewed": False
-                }, on_conflict="exam_id,student_id").execute()
-                
-                # Create illegible flags if needed
-                if has_illegible:
-                    # Get the result ID
-                    result_data = supabase.table("results").select("id").eq("exam_id", exam_id).eq("student_id", student_id).execute()
-                    result_id = result_data.data[0]["id"]
-                    
-                    for qid, result in breakdown.items():
-                        if result.illegible:
-                            supabase.table("illegible_flags").insert({
-                                "result_id": result_id,
-                                "exam_id": exam_id,
-                                "student_id": student_id,
-                                "question_id": qid,
-                                "original_answer_path": sheet["file_path"]
-                            }).execute()
-                
-                # Update answer sheet with student ID and mark as processed
-                supabase.table("answer_sheets").update({
-                    "student_id": student_id,
-                    "processed": True
-                }).eq("id", sheet["id"]).execute()
-                
-                processed_count += 1
-                
-                # Update job progress
+        async def evaluate_with_limit(sheet: dict):
+            nonlocal processed_count
+            async with semaphore:
+                if not await evaluate_sheet(exam_id, sheet, questions, prompt):
+                    return
+            
+            processed_count += 1
+            if processed_count % flush_every == 0 or time.monotonic() - last_flush > 2:
+                await flush_progress()
+        
+        await asyncio.gather(
+            *[evaluate_with_limit(sheet) for sheet in sheets_result.data],
+            return_exceptions=True
+        )
+        
+        # Mark job as completed, always recording the final count, and
+        # update the exam status
+        await asyncio.gather(
+            asyncio.to_thread(
                 supabase.table("evaluation_jobs").update({
-                    "processed_sheets": processed_count
-                }).eq("id", job_id).execute()
-                
-            except Exception as e:
-                print(f"Error processing sheet {sheet['id']}: {e}")
-                # Continue with next sheet
-                continue
-        
-        # Mark job as completed
-        supabase.table("evaluation_jobs").update({
-            "status": "completed",
-            "completed_at": datetime.utcnow().isoformat()
-        }).eq("id", job_id).execute()
-        
-        # Update exam status
-        supabase.table("exams").update({"status": "completed"}).eq("exam_id", exam_id).execute()
+                    "status": "completed",
+                    "processed_sheets": processed_count,
+                    "completed_at": datetime.utcnow().isoformat()
+                }).eq("id", job_id).execute
+            ),
+            asyncio.to_thread(supabase.table("exams").update({"status": "completed"}).eq("exam_id", exam_id).execute)
+        )
+        invalidate("exams", exam_id)
+        invalidate("answer_sheets", exam_id)
         
     except Exception as e:
-        # Mark job as failed
-        supabase.table("evaluation_jobs").update({
-            "status": "failed",
-            "error_message": str(e),
-            "completed_at": datetime.utcnow().isoformat()
-        }).eq("id", job_id).execute()
-        
-        # Revert exam status
-        supabase.table("exams").update({"status": "ready"}).eq("exam_id", exam_id).execute()
+        # Mark job as failed and revert the exam status
+        await asyncio.gather(
+            asyncio.to_thread(
+                supabase.table("evaluation_jobs").update({
+                    "status": "failed",
+                    "error_message": str(e),
+                    "completed_at": datetime.utcnow().isoformat()
+                }).eq("id", job_id).execute
+            ),
+            asyncio.to_thread(supabase.table("exams").update({"status": "ready"}).eq("exam_id", exam_id).execute)
+        )
+        invalidate("exams", exam_id)
+        invalidate("answer_sheets", exam_id)
         
         raise
     finally:
@@ -192,6 +200,75 @@ async def process_evaluation(job_id: str, exam_id: str):
             del running_jobs[job_id]
 
 
+async def evaluate_sheet(
+    exam_id: str,
+    sheet: dict,
+    questions: list[Question],
+    prompt: str
+) -> bool:
+    """
+    Evaluate a single answer sheet and persist its result.
+    
+    Errors are logged and swallowed so one bad sheet doesn't fail the job.
+    A sheet that fails stays unprocessed, so the next run retries it.
+    
+    Args:
+        exam_id: The exam ID
+        sheet: The answer sheet row
+        questions: List of questions with rubrics
+        prompt: Grading prompt built once per exam by build_sheet_prompt
+        
+    Returns:
+        True if the sheet was evaluated and saved
+    """
+    supabase = get_supabase_client()
+    
+    try:
+        # Download PDF
+        pdf_bytes = await download_pdf(sheet["file_path"])
+        
+        # Evaluate with Gemini
+        student_id, breakdown = await evaluate_full_answer_sheet(pdf_bytes, questions, prompt)
+        
+        # Use extracted student ID or fallback to sheet ID
+        if not student_id:
+            student_id = f"UNKNOWN_{sheet['id'][:8]}"
+        
+        # Calculate totals
+        total_marks = 0.0
+        max_marks = 0.0
+        illegible_questions = []
+        
+        for qid, result in breakdown.items():
+            max_marks += result["max"]
+            if result["illegible"]:
+                illegible_questions.append(qid)
+            elif result["awarded"] is not None:
+                total_marks += result["awarded"]
+        
+        # Save result, illegible flags and sheet status in a single
+        # round trip (see evaluate_sheet_commit in sql/migrations.sql)
+        await asyncio.to_thread(
+            supabase.rpc("evaluate_sheet_commit", {
+                "p_exam_id": exam_id,
+                "p_student_id": student_id,
+                "p_total_marks": total_marks,
+                "p_max_marks": max_marks,
+                "p_breakdown": breakdown,
+                "p_has_illegible": bool(illegible_questions),
+                "p_illegible_questions": illegible_questions,
+                "p_file_path": sheet["file_path"],
+                "p_sheet_id": sheet["id"]
+            }).execute
+        )
+        
+        return True
+        
+    except Exception as e:
+        print(f"Error processing sheet {sheet['id']}: {e}")
+        return False
+
+
 def get_job_status(job_id: str) -> Optional[dict]:
     """
     Get the status of an evaluation job.
@@ -203,10 +280,10 @@ def get_job_status(job_id: str) -> Optional[dict]:
         Job status dict or None if not found
     """
     supabase = get_supabase_client()
-    result = supabase.table("evaluation_jobs").select("*").eq("id", job_id).execute()
+    result = supabase.table("evaluation_jobs").select("*").eq("id", job_id).limit(1).maybe_single().execute()
     
-    if result.data:
-        return result.data[0]
+    if result:
+        return result.data
     return None
 
 
@@ -221,8 +298,8 @@ def get_exam_job_status(exam_id: str) -> Optional[dict]:
         Job status dict or None if not found
     """
     supabase = get_supabase_client()
-    result = supabase.table("evaluation_jobs").select("*").eq("exam_id", exam_id).order("created_at", desc=True).limit(1).execute()
+    result = supabase.table("evaluation_jobs").select("*").eq("exam_id", exam_id).order("created_at", desc=True).limit(1).maybe_single().execute()
     
-    if result.data:
-        return result.data[0]
+    if result:
+        return result.data
     return None
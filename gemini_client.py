@@ -4,131 +4,188 @@ Uses the new google-genai package.
 """
 from google import genai
 from google.genai import types
-import json
-import re
-from typing import Optional
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Optional
+import io
+import orjson
 
 from config import get_settings
-from schemas import Question, QuestionBreakdown
+from schemas import Question, QuestionBreakdown, LegibleBreakdown, IllegibleBreakdown
 
 
 # Initialize Gemini client
 settings = get_settings()
 client = genai.Client(api_key=settings.GOOGLE_API_KEY)
 
+# Gemini rejects inline requests over 20MB and base64 adds ~33%,
+# so anything larger goes through the Files API instead
+INLINE_PDF_MAX_BYTES = 14 * 1024 * 1024
 
-async def extract_student_id(pdf_bytes: bytes) -> Optional[str]:
+# Handwritten answers can trip the default filters, so disable blocking.
+# Built once and shared by every request.
+SAFETY_SETTINGS = [
+    types.SafetySetting(category=category, threshold="BLOCK_NONE")
+    for category in (
+        "HARM_CATEGORY_HARASSMENT",
+        "HARM_CATEGORY_HATE_SPEECH",
+        "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "HARM_CATEGORY_DANGEROUS_CONTENT",
+    )
+]
+GENERATE_CONFIG = types.GenerateContentConfig(safety_settings=SAFETY_SETTINGS)
+
+
+def _strip_code_fence(response_text: str) -> str:
+    """Remove a surrounding markdown code block from a JSON response, if present."""
+    response_text = response_text.strip()
+    
+    if response_text.startswith("```"):
+        response_text = response_text.removeprefix("```json").removeprefix("```").lstrip("\n")
+        response_text = response_text.removesuffix("```").rstrip()
+    
+    return response_text
+
+
+def _clean_student_id(raw: Any) -> Optional[str]:
+    """Normalize a student ID read by Gemini, returning None if it is unusable."""
+    # Gemini sometimes returns a numeric ID as a JSON number
+    student_id = str(raw).strip() if raw is not None else ""
+    
+    # Validate - should be alphanumeric, not too long
+    if student_id and student_id != "UNKNOWN" and len(student_id) <= 20:
+        # Clean up any extra whitespace or newlines
+        return "".join(student_id.split())
+    
+    return None
+
+
+def _parse_breakdown(result: dict, question: Question) -> QuestionBreakdown:
     """
-    Extract the student ID from the top of a handwritten answer sheet.
+    Build a QuestionBreakdown from Gemini's JSON grade for one question.
     
-    Args:
-        pdf_bytes: The PDF file content as bytes
-        
-    Returns:
-        Extracted student ID or None if not found
+    Values are coerced and clamped here, so no further validation is needed.
     """
-    prompt = """Analyze this handwritten exam answer sheet. 
-Your task is to find and extract the STUDENT ID (also called Roll Number, Registration Number, or similar).
+    max_marks = float(result.get("max", question.max_marks))
+    justification = str(result.get("justification", "Grading completed"))
+    confidence = min(1.0, max(0.0, float(result.get("confidence", 0.5))))
+    
+    # A grade without marks can't be trusted either, so flag it for review
+    awarded = result.get("awarded")
+    if result.get("illegible") or awarded is None:
+        return IllegibleBreakdown(
+            awarded=None,
+            max=max_marks,
+            justification=justification,
+            confidence=confidence,
+            illegible=True
+        )
+    
+    return LegibleBreakdown(
+        awarded=float(awarded),
+        max=max_marks,
+        justification=justification,
+        confidence=confidence,
+        illegible=False
+    )
 
-The student ID is typically:
-- Written at the TOP of the first page
-- In a designated field/box
-- Could be in format like: 21CS045, 2021BCS0123, ABC123, etc.
 
-Return ONLY the student ID as plain text, nothing else.
-If you cannot find or read the student ID clearly, return exactly: UNKNOWN
+def _error_breakdown(question: Question, message: str) -> QuestionBreakdown:
+    """Safe default when a question could not be graded; flags it for review."""
+    return IllegibleBreakdown(
+        awarded=None,
+        max=question.max_marks,
+        justification=message,
+        confidence=0.0,
+        illegible=True
+    )
 
-Example valid responses:
-21CS045
-2021BCS0123
-UNKNOWN"""
 
+@asynccontextmanager
+async def _pdf_part(pdf_bytes: bytes) -> AsyncIterator[types.Part]:
+    """
+    Turn an answer sheet PDF into a content part for Gemini.
+    
+    Small PDFs are sent inline. Large ones are uploaded once to the
+    Files API, referenced by URI, and deleted when the block exits.
+    
+    Args:
+        pdf_bytes: The PDF file content as bytes
+    """
+    if len(pdf_bytes) <= INLINE_PDF_MAX_BYTES:
+        yield types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
+        return
+    
+    file = await client.aio.files.upload(
+        file=io.BytesIO(pdf_bytes),
+        config={"mime_type": "application/pdf"}
+    )
     try:
-        response = client.models.generate_content(
-            model=settings.GEMINI_MODEL,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_text(text=prompt),
-                        types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
-                    ]
-                )
-            ],
-            config=types.GenerateContentConfig(
-                safety_settings=[
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_HARASSMENT",
-                        threshold="BLOCK_NONE"
-                    ),
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_HATE_SPEECH",
-                        threshold="BLOCK_NONE"
-                    ),
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        threshold="BLOCK_NONE"
-                    ),
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                        threshold="BLOCK_NONE"
-                    ),
+        yield types.Part.from_uri(file_uri=file.uri, mime_type="application/pdf")
+    finally:
+        try:
+            await client.aio.files.delete(name=file.name)
+        except Exception as e:
+            # Uploaded files expire on their own after 48 hours
+            print(f"Error deleting Gemini file {file.name}: {e}")
+
+
+async def _generate(prompt: str, pdf_part: types.Part) -> str:
+    """
+    Send a prompt together with the answer sheet PDF to Gemini.
+    
+    Args:
+        prompt: The instruction text
+        pdf_part: The answer sheet PDF, from _pdf_part
+        
+    Returns:
+        The raw response text
+    """
+    response = await client.aio.models.generate_content(
+        model=settings.GEMINI_MODEL,
+        contents=[
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_text(text=prompt),
+                    pdf_part
                 ]
             )
-        )
-        
-        student_id = response.text.strip()
-        
-        # Validate - should be alphanumeric, not too long
-        if student_id and student_id != "UNKNOWN" and len(student_id) <= 20:
-            # Clean up any extra whitespace or newlines
-            student_id = re.sub(r'\s+', '', student_id)
-            return student_id
-        
-        return None
-        
-    except Exception as e:
-        print(f"Error extracting student ID: {e}")
-        return None
+        ],
+        config=GENERATE_CONFIG
+    )
+    
+    return response.text
 
 
-async def evaluate_answer(
-    pdf_bytes: bytes,
-    question: Question,
-    question_number: int = 1
-) -> QuestionBreakdown:
+def build_sheet_prompt(questions: list[Question]) -> str:
     """
-    Evaluate a student's handwritten answer against the rubric.
+    Build a single prompt that extracts the student ID and grades every question.
     
     Args:
-        pdf_bytes: The PDF file content as bytes
-        question: The question with rubric and keywords
-        question_number: Position of the question (for context)
+        questions: List of questions with rubrics
         
     Returns:
-        QuestionBreakdown with marks, justification, and confidence
+        The prompt text
     """
-    # Build rubric description
-    rubric_text = "\n".join([
-        f"  - {item.point}: {item.marks} marks"
-        for item in question.rubric
-    ])
-    
-    keywords_text = ", ".join(question.keywords) if question.keywords else "None specified"
+    questions_json = orjson.dumps(
+        [q.model_dump() for q in questions], option=orjson.OPT_INDENT_2
+    ).decode()
     
-    prompt = f"""You are an expert exam grader. Analyze the handwritten answer sheet and grade Question {question.qid}.
+    return f"""You are an expert exam grader. Analyze the handwritten answer sheet, extract the student ID and grade every question in the answer key below.
 
-## Question Details:
-- Question ID: {question.qid}
-- Maximum Marks: {question.max_marks}
+## Student ID:
+Find the STUDENT ID (also called Roll Number, Registration Number, or similar).
+It is typically written at the TOP of the first page, in a designated field/box,
+in a format like: 21CS045, 2021BCS0123, ABC123, etc.
+If you cannot find or read the student ID clearly, use exactly: UNKNOWN
 
-## Grading Rubric:
-{rubric_text}
-
-## Keywords to look for: {keywords_text}
+## Answer Key (JSON):
+Each entry has the question ID ("qid"), maximum marks ("max_marks"),
+grading rubric points with their marks ("rubric") and keywords to look for ("keywords").
+{questions_json}
 
 ## Instructions:
-1. Locate the answer for Question {question.qid} in the PDF
+1. Locate the answer for each question in the PDF
 2. Read and interpret the handwritten answer carefully
 3. Compare against each rubric point and award partial marks as appropriate
 4. Consider keywords as positive indicators but don't require exact matches
@@ -140,107 +197,79 @@ async def evaluate_answer(
 
 ## Required JSON Response Format:
 {{
-  "awarded": <number or null if illegible>,
-  "max": {question.max_marks},
-  "justification": "<detailed explanation of grading decision>",
-  "confidence": <0.0 to 1.0 - your confidence in this grading>,
-  "illegible": <true if cannot read, false otherwise>
+  "student_id": "<student ID or UNKNOWN>",
+  "answers": {{
+    "<qid>": {{
+      "awarded": <number or null if illegible>,
+      "max": <max_marks of the question>,
+      "justification": "<detailed explanation of grading decision>",
+      "confidence": <0.0 to 1.0 - your confidence in this grading>,
+      "illegible": <true if cannot read, false otherwise>
+    }}
+  }}
 }}
+Include an entry in "answers" for every qid in the answer key.
 
 IMPORTANT: Return ONLY valid JSON, no markdown formatting or explanations outside the JSON."""
 
-    try:
-        response = client.models.generate_content(
-            model=settings.GEMINI_MODEL,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_text(text=prompt),
-                        types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
-                    ]
-                )
-            ],
-            config=types.GenerateContentConfig(
-                safety_settings=[
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_HARASSMENT",
-                        threshold="BLOCK_NONE"
-                    ),
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_HATE_SPEECH",
-                        threshold="BLOCK_NONE"
-                    ),
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        threshold="BLOCK_NONE"
-                    ),
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                        threshold="BLOCK_NONE"
-                    ),
-                ]
-            )
-        )
-        
-        # Parse the JSON response
-        response_text = response.text.strip()
-        
-        # Handle markdown code blocks if present
-        if response_text.startswith("```"):
-            response_text = re.sub(r'^```(?:json)?\n?', '', response_text)
-            response_text = re.sub(r'\n?```$', '', response_text)
-        
-        result = json.loads(response_text)
-        
-        return QuestionBreakdown(
-            awarded=result.get("awarded"),
-            max=result.get("max", question.max_marks),
-            justification=result.get("justification", "Grading completed"),
-            confidence=min(1.0, max(0.0, result.get("confidence", 0.5))),
-            illegible=result.get("illegible", False)
-        )
-        
-    except json.JSONDecodeError as e:
-        # If JSON parsing fails, return a safe default
-        return QuestionBreakdown(
-            awarded=None,
-            max=question.max_marks,
-            justification=f"Error parsing AI response: {str(e)}",
-            confidence=0.0,
-            illegible=True
-        )
-    except Exception as e:
-        return QuestionBreakdown(
-            awarded=None,
-            max=question.max_marks,
-            justification=f"Error during evaluation: {str(e)}",
-            confidence=0.0,
-            illegible=True
-        )
-
 
 async def evaluate_full_answer_sheet(
     pdf_bytes: bytes,
-    questions: list[Question]
+    questions: list[Question],
+    prompt: Optional[str] = None
 ) -> tuple[Optional[str], dict[str, QuestionBreakdown]]:
     """
     Evaluate an entire answer sheet against all questions.
     
+    The student ID and all question grades come back from a single
+    Gemini call, so the PDF is sent and processed only once per sheet.
+    
     Args:
         pdf_bytes: The PDF file content as bytes
         questions: List of questions with rubrics
+        prompt: Prebuilt prompt from build_sheet_prompt, built here if omitted.
+            The prompt depends only on the answer key, so callers grading
+            many sheets should build it once and pass it in.
         
     Returns:
         Tuple of (student_id, breakdown dict)
+        
+    Raises:
+        ValueError: If Gemini's response isn't the expected JSON object.
+            Gemini errors are raised as-is. Either way nothing was graded,
+            so the caller should leave the sheet to be retried.
     """
-    # First extract student ID
-    student_id = await extract_student_id(pdf_bytes)
+    if prompt is None:
+        prompt = build_sheet_prompt(questions)
+    
+    async with _pdf_part(pdf_bytes) as pdf_part:
+        response_text = await _generate(prompt, pdf_part)
+    
+    try:
+        result = orjson.loads(_strip_code_fence(response_text))
+    except orjson.JSONDecodeError as e:
+        raise ValueError(f"Error parsing AI response: {str(e)}")
+    
+    if not isinstance(result, dict):
+        raise ValueError("AI response is not a JSON object")
+    
+    answers = result.get("answers")
+    if not isinstance(answers, dict):
+        raise ValueError("AI response has no answers object")
+    
+    student_id = _clean_student_id(result.get("student_id"))
     
-    # Then evaluate each question
     breakdown = {}
-    for i, question in enumerate(questions, 1):
-        result = await evaluate_answer(pdf_bytes, question, i)
-        breakdown[question.qid] = result
+    for question in questions:
+        answer = answers.get(question.qid)
+        if isinstance(answer, dict):
+            try:
+                breakdown[question.qid] = _parse_breakdown(answer, question)
+                continue
+            except Exception as e:
+                message = f"Error during evaluation: {str(e)}"
+        else:
+            message = "No grade returned for this question"
+        breakdown[question.qid] = _error_breakdown(question, message)
     
     return student_id, breakdown
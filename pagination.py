@@ -0,0 +1,69 @@
+"""
+Keyset (cursor) pagination helpers for list endpoints.
+"""
+from fastapi import HTTPException, Response, status
+from datetime import datetime
+from typing import Any, Optional
+import base64
+import orjson
+import uuid
+
+
+# Response header carrying the cursor for the next page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(value: Any, row_id: str) -> str:
+    """Encode the sort value and id of the last row on a page."""
+    return base64.urlsafe_b64encode(orjson.dumps([str(value), row_id])).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+    """
+    Decode a cursor produced by encode_cursor.
+
+    The values end up inside a PostgREST filter, so they are parsed as a
+    timestamp and a UUID and re-serialized rather than used as sent.
+
+    Raises:
+        HTTPException: 400 if the cursor is malformed
+    """
+    try:
+        value, row_id = orjson.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(value).isoformat(), str(uuid.UUID(row_id))
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor"
+        )
+
+
+def paginate(query, column: str, cursor: Optional[str], limit: int):
+    """
+    Order a query newest first and restrict it to the page after a cursor.
+
+    Rows are ordered by (column, id) descending so rows sharing a
+    timestamp - e.g. a bulk upload - are never skipped between pages.
+
+    Args:
+        query: A PostgREST select query
+        column: The timestamp column to page by
+        cursor: Cursor from the previous page's X-Next-Cursor header
+        limit: Page size
+
+    Returns:
+        The ordered, limited query
+    """
+    if cursor:
+        value, row_id = decode_cursor(cursor)
+        query = query.or_(
+            f'{column}.lt."{value}",and({column}.eq."{value}",id.lt."{row_id}")'
+        )
+    return query.order(column, desc=True).order("id", desc=True).limit(limit)
+
+
+def set_next_cursor(response: Response, items: list, column: str, limit: int):
+    """Point the client at the next page if this one was full."""
+    if len(items) == limit:
+        last = items[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(getattr(last, column), last.id)
@@ -0,0 +1,81 @@
+"""
+Request body parsing that validates raw JSON bytes in a single pass.
+
+FastAPI decodes a JSON body into Python dicts with the stdlib json module
+and then validates those dicts. Handing the raw bytes to
+model_validate_json instead lets pydantic-core parse and validate in one
+step, without building the intermediate dicts.
+
+FastAPI resolves dependencies in signature order, so declare json_body
+after the auth dependency - otherwise unauthenticated requests get the
+body parsed and a 422 with validation details instead of a 401.
+
+Usage:
+    @router.post("", openapi_extra=json_body_openapi(ExamCreate))
+    async def create_exam(
+        user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN)),
+        exam: ExamCreate = Depends(json_body(ExamCreate))
+    ):
+        ...
+"""
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from typing import Any, Awaitable, Callable, TypeVar
+
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+def json_body(model: type[ModelT]) -> Callable[[Request], Awaitable[ModelT]]:
+    """
+    Build a dependency that validates the request body as a model.
+
+    Args:
+        model: The pydantic model the body must match
+
+    Returns:
+        A dependency returning the validated model. Invalid bodies get the
+        same 422 response as a regular FastAPI body parameter.
+    """
+    async def parse_body(request: Request) -> ModelT:
+        body = await request.body()
+        try:
+            return model.model_validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError(
+                [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)],
+                body=body
+            )
+
+    return parse_body
+
+
+def json_body_openapi(model: type[BaseModel]) -> dict[str, Any]:
+    """
+    Describe a json_body request body in the OpenAPI schema.
+
+    A dependency hides the body from FastAPI, so pass this as the route's
+    openapi_extra to keep it in the docs.
+    """
+    schema = model.model_json_schema()
+    defs = schema.pop("$defs", {})
+
+    # Nested models are emitted as local $refs, which don't resolve inside
+    # the OpenAPI document, so inline them
+    def inline(node: Any) -> Any:
+        if isinstance(node, dict):
+            ref = node.get("$ref")
+            if ref and ref.startswith("#/$defs/"):
+                return inline(defs[ref.removeprefix("#/$defs/")])
+            return {key: inline(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [inline(item) for item in node]
+        return node
+
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": inline(schema)}}
+        }
+    }
@@ -1,24 +1,33 @@
 """
 Answer key management endpoints.
 """
-from fastapi import APIRouter, Depends, HTTPException, status
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from postgrest.exceptions import APIError
 
 from auth import require_role
 from schemas import (
     AnswerKeyCreate, AnswerKeyResponse, ExamStatus,
     UserProfile, UserRole
 )
-from supabase_client import get_supabase_client
+from supabase_client import get_supabase_client, FOREIGN_KEY_VIOLATION
+from cache import get_cached, set_cached, invalidate, check_etag
+from request_body import json_body, json_body_openapi
 
 
 router = APIRouter(prefix="/exams/{exam_id}/answer-key", tags=["Answer Keys"])
 
 
-@router.post("", response_model=AnswerKeyResponse, status_code=status.HTTP_201_CREATED)
+@router.post(
+    "",
+    response_model=AnswerKeyResponse,
+    status_code=status.HTTP_201_CREATED,
+    openapi_extra=json_body_openapi(AnswerKeyCreate)
+)
 async def create_answer_key(
     exam_id: str,
-    answer_key: AnswerKeyCreate,
-    user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN))
+    user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN)),
+    answer_key: AnswerKeyCreate = Depends(json_body(AnswerKeyCreate))
 ):
     """
     Create or update the answer key for an exam.
@@ -28,22 +37,24 @@ async def create_answer_key(
     """
     supabase = get_supabase_client()
     
-    # Check exam exists
-    exam_result = supabase.table("exams").select("*").eq("exam_id", exam_id).execute()
-    if not exam_result.data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Exam '{exam_id}' not found"
-        )
-    
     # Convert questions to dict for JSON storage
     questions_data = [q.model_dump() for q in answer_key.questions]
     
-    # Upsert answer key (create or update)
-    result = supabase.table("answer_keys").upsert({
-        "exam_id": exam_id,
-        "questions": questions_data
-    }, on_conflict="exam_id").execute()
+    # Upsert answer key and flip a draft exam to ready in one call
+    try:
+        result = await asyncio.to_thread(
+            supabase.rpc("save_answer_key", {
+                "p_exam_id": exam_id,
+                "p_questions": questions_data
+            }).execute
+        )
+    except APIError as e:
+        if e.code == FOREIGN_KEY_VIOLATION:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Exam '{exam_id}' not found"
+            )
+        raise
     
     if not result.data:
         raise HTTPException(
@@ -51,16 +62,18 @@ async def create_answer_key(
             detail="Failed to save answer key"
         )
     
-    # Update exam status to ready if still draft
-    if exam_result.data[0]["status"] == ExamStatus.DRAFT.value:
-        supabase.table("exams").update({"status": ExamStatus.READY.value}).eq("exam_id", exam_id).execute()
+    # Saving a key can also flip the exam's status
+    invalidate("answer_keys", exam_id)
+    invalidate("exams", exam_id)
     
-    return AnswerKeyResponse(**result.data[0])
+    return AnswerKeyResponse.model_validate(result.data)
 
 
 @router.get("", response_model=AnswerKeyResponse)
 async def get_answer_key(
     exam_id: str,
+    request: Request,
+    response: Response,
     user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN))
 ):
     """
@@ -68,17 +81,28 @@ async def get_answer_key(
     
     Only professors and admins can view answer keys.
     """
-    supabase = get_supabase_client()
+    answer_key = get_cached("answer_keys", exam_id)
     
-    result = supabase.table("answer_keys").select("*").eq("exam_id", exam_id).execute()
+    if answer_key is None:
+        supabase = get_supabase_client()
+        
+        result = await asyncio.to_thread(supabase.table("answer_keys").select("*").eq("exam_id", exam_id).execute)
+        
+        if not result.data:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Answer key not found for exam '{exam_id}'"
+            )
+        
+        # Validated rather than constructed so the nested questions become models
+        answer_key = set_cached(AnswerKeyResponse.model_validate(result.data[0]), "answer_keys", exam_id)
     
-    if not result.data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Answer key not found for exam '{exam_id}'"
-        )
+    # Skip the body entirely if the client already has this version
+    not_modified = check_etag(request, response, answer_key.id, answer_key.updated_at)
+    if not_modified:
+        return not_modified
     
-    return AnswerKeyResponse(**result.data[0])
+    return answer_key
 
 
 @router.delete("", status_code=status.HTTP_204_NO_CONTENT)
@@ -93,15 +117,16 @@ async def delete_answer_key(
     """
     supabase = get_supabase_client()
     
-    # Check exists
-    existing = supabase.table("answer_keys").select("id").eq("exam_id", exam_id).execute()
-    if not existing.data:
+    # Delete and check the returned rows instead of checking existence first
+    deleted = await asyncio.to_thread(supabase.table("answer_keys").delete().eq("exam_id", exam_id).execute)
+    if not deleted.data:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Answer key not found for exam '{exam_id}'"
         )
     
-    supabase.table("answer_keys").delete().eq("exam_id", exam_id).execute()
-    
     # Revert exam status to draft
-    supabase.table("exams").update({"status": ExamStatus.DRAFT.value}).eq("exam_id", exam_id).execute()
+    await asyncio.to_thread(supabase.table("exams").update({"status": ExamStatus.DRAFT.value}).eq("exam_id", exam_id).execute)
+    
+    invalidate("answer_keys", exam_id)
+    invalidate("exams", exam_id)
@@ -1,13 +1,23 @@
 """
 Answer sheet upload endpoints.
 """
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
-from typing import List
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status, UploadFile, File
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from typing import List, Optional
+from urllib.parse import quote
+from postgrest.exceptions import APIError
 
 from auth import require_role
 from schemas import AnswerSheetResponse, UserProfile, UserRole
-from supabase_client import get_supabase_client
-from storage import upload_pdf, get_pdf_url, list_pdfs
+from supabase_client import get_supabase_client, FOREIGN_KEY_VIOLATION
+from storage import (
+    bulk_upload_pdfs, get_pdf_url, get_pdf_urls, stream_pdf,
+    list_pdfs, delete_pdf, delete_pdfs, check_upload_size
+)
+from cache import get_cached, set_cached, invalidate
+from pagination import paginate, set_next_cursor
 
 
 router = APIRouter(prefix="/exams/{exam_id}/answer-sheets", tags=["Answer Sheets"])
@@ -27,40 +37,55 @@ async def upload_answer_sheets(
     """
     supabase = get_supabase_client()
     
-    # Check exam exists
-    exam_result = supabase.table("exams").select("*").eq("exam_id", exam_id).execute()
-    if not exam_result.data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Exam '{exam_id}' not found"
-        )
+    # Validate file type
+    pdf_files = [
+        file for file in files
+        if file.filename and file.filename.lower().endswith('.pdf')
+    ]
     
-    uploaded_sheets = []
+    # Fail the whole request up front rather than uploading part of it
+    for file in pdf_files:
+        check_upload_size(file)
+    
+    # Upload to storage concurrently, bounded so a large batch doesn't
+    # exhaust the connection pool
+    uploads = await bulk_upload_pdfs(exam_id, pdf_files)
     
-    for file in files:
-        # Validate file type
-        if not file.filename or not file.filename.lower().endswith('.pdf'):
+    rows = []
+    for file, file_path in zip(pdf_files, uploads):
+        if isinstance(file_path, Exception):
+            # Log error but continue with other files
+            print(f"Error uploading {file.filename}: {file_path}")
             continue
         
+        rows.append({
+            "exam_id": exam_id,
+            "file_path": file_path,
+            "file_name": file.filename,
+            "processed": False
+        })
+    
+    # Create all database records in one bulk insert. There is no exam
+    # precheck: a missing exam fails the insert's foreign key instead.
+    uploaded_sheets = []
+    if rows:
         try:
-            # Upload to storage
-            file_path = await upload_pdf(exam_id, file)
-            
-            # Create database record
-            result = supabase.table("answer_sheets").insert({
-                "exam_id": exam_id,
-                "file_path": file_path,
-                "file_name": file.filename,
-                "processed": False
-            }).execute()
-            
-            if result.data:
-                uploaded_sheets.append(AnswerSheetResponse(**result.data[0]))
-                
+            result = await asyncio.to_thread(supabase.table("answer_sheets").insert(rows).execute)
+            uploaded_sheets = [AnswerSheetResponse.model_construct(**sheet) for sheet in result.data]
         except Exception as e:
-            # Log error but continue with other files
-            print(f"Error uploading {file.filename}: {e}")
-            continue
+            # Don't leave the uploaded files orphaned in storage
+            await delete_pdfs([row["file_path"] for row in rows])
+            
+            if isinstance(e, APIError) and e.code == FOREIGN_KEY_VIOLATION:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Exam '{exam_id}' not found"
+                )
+            print(f"Error saving answer sheets for exam {exam_id}: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to save answer sheets"
+            )
     
     if not uploaded_sheets:
         raise HTTPException(
@@ -68,17 +93,27 @@ async def upload_answer_sheets(
             detail="No valid PDF files were uploaded"
         )
     
+    invalidate("answer_sheets", exam_id)
+    
     return uploaded_sheets
 
 
 @router.get("", response_model=list[AnswerSheetResponse])
 async def list_answer_sheets(
     exam_id: str,
+    response: Response,
     processed_only: bool = False,
+    include_urls: bool = False,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
     user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN))
 ):
     """
-    List all uploaded answer sheets for an exam.
+    List uploaded answer sheets for an exam, newest first.
+    
+    Results are paginated; pass the X-Next-Cursor response header back
+    as `cursor` to get the next page. Set `include_urls` to get a signed
+    URL for every sheet on the page.
     """
     supabase = get_supabase_client()
     
@@ -87,9 +122,20 @@ async def list_answer_sheets(
     if processed_only:
         query = query.eq("processed", True)
     
-    result = query.order("uploaded_at", desc=True).execute()
+    result = await asyncio.to_thread(paginate(query, "uploaded_at", cursor, limit).execute)
     
-    return [AnswerSheetResponse(**sheet) for sheet in result.data]
+    # Sign the whole page in one storage request rather than one per sheet
+    urls = {}
+    if include_urls:
+        urls = await get_pdf_urls([sheet["file_path"] for sheet in result.data])
+    
+    sheets = [
+        AnswerSheetResponse.model_construct(**sheet, url=urls.get(sheet["file_path"]))
+        for sheet in result.data
+    ]
+    set_next_cursor(response, sheets, "uploaded_at", limit)
+    
+    return sheets
 
 
 @router.get("/{sheet_id}", response_model=AnswerSheetResponse)
@@ -103,7 +149,7 @@ async def get_answer_sheet(
     """
     supabase = get_supabase_client()
     
-    result = supabase.table("answer_sheets").select("*").eq("id", sheet_id).eq("exam_id", exam_id).execute()
+    result = await asyncio.to_thread(supabase.table("answer_sheets").select("*").eq("id", sheet_id).eq("exam_id", exam_id).execute)
     
     if not result.data:
         raise HTTPException(
@@ -111,7 +157,7 @@ async def get_answer_sheet(
             detail="Answer sheet not found"
         )
     
-    return AnswerSheetResponse(**result.data[0])
+    return AnswerSheetResponse.model_construct(**result.data[0])
 
 
 @router.get("/{sheet_id}/url")
@@ -123,9 +169,14 @@ async def get_answer_sheet_url(
     """
     Get a signed URL to view/download an answer sheet.
     """
+    # Signed URLs stay valid for an hour, so reusing one for 30s is safe
+    cached = get_cached("answer_sheets", exam_id, sheet_id)
+    if cached is not None:
+        return cached
+    
     supabase = get_supabase_client()
     
-    result = supabase.table("answer_sheets").select("file_path").eq("id", sheet_id).eq("exam_id", exam_id).execute()
+    result = await asyncio.to_thread(supabase.table("answer_sheets").select("file_path").eq("id", sheet_id).eq("exam_id", exam_id).execute)
     
     if not result.data:
         raise HTTPException(
@@ -133,9 +184,44 @@ async def get_answer_sheet_url(
             detail="Answer sheet not found"
         )
     
-    url = get_pdf_url(result.data[0]["file_path"])
+    url = await get_pdf_url(result.data[0]["file_path"])
+    
+    return set_cached({"url": url, "expires_in_seconds": 3600}, "answer_sheets", exam_id, sheet_id)
+
+
+@router.get("/{sheet_id}/file", response_class=StreamingResponse)
+async def download_answer_sheet(
+    exam_id: str,
+    sheet_id: str,
+    user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN))
+):
+    """
+    Download an answer sheet PDF.
+    
+    The file is streamed through as it arrives from storage, so viewers
+    can start rendering before the whole PDF has been fetched.
+    """
+    supabase = get_supabase_client()
+    
+    result = await asyncio.to_thread(supabase.table("answer_sheets").select("file_path,file_name").eq("id", sheet_id).eq("exam_id", exam_id).execute)
+    
+    if not result.data:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Answer sheet not found"
+        )
     
-    return {"url": url, "expires_in_seconds": 3600}
+    sheet = result.data[0]
+    chunks, storage_response = await stream_pdf(sheet["file_path"])
+    
+    # Closing in a background task returns the connection to the pool
+    # even if the client disconnects before the body is sent
+    return StreamingResponse(
+        chunks,
+        media_type="application/pdf",
+        background=BackgroundTask(storage_response.aclose),
+        headers={"Content-Disposition": f"inline; filename*=utf-8''{quote(sheet['file_name'])}"}
+    )
 
 
 @router.delete("/{sheet_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -151,16 +237,15 @@ async def delete_answer_sheet(
     """
     supabase = get_supabase_client()
     
-    # Check exists
-    existing = supabase.table("answer_sheets").select("*").eq("id", sheet_id).eq("exam_id", exam_id).execute()
-    if not existing.data:
+    # Delete the row first; the returned row tells us whether it existed
+    # and which file to remove from storage
+    deleted = await asyncio.to_thread(supabase.table("answer_sheets").delete().eq("id", sheet_id).eq("exam_id", exam_id).execute)
+    if not deleted.data:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Answer sheet not found"
         )
     
-    # Delete from storage and database
-    from storage import delete_pdf
-    delete_pdf(existing.data[0]["file_path"])
+    invalidate("answer_sheets", exam_id)
     
-    supabase.table("answer_sheets").delete().eq("id", sheet_id).execute()
+    await delete_pdf(deleted.data[0]["file_path"])
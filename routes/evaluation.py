@@ -1,6 +1,7 @@
 """
 Evaluation trigger and status endpoints.
 """
+import asyncio
 from fastapi import APIRouter, Depends, HTTPException, status
 
 from auth import require_role
@@ -33,8 +34,8 @@ async def trigger_evaluation(
     """
     supabase = get_supabase_client()
     
-    # Check exam exists
-    exam_result = supabase.table("exams").select("*").eq("exam_id", exam_id).execute()
+    # Check exam exists (status is all we need from it)
+    exam_result = await asyncio.to_thread(supabase.table("exams").select("status").eq("exam_id", exam_id).execute)
     if not exam_result.data:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -79,7 +80,7 @@ async def get_evaluation_status(
     """
     Get the status of the latest evaluation job for an exam.
     """
-    job = get_exam_job_status(exam_id)
+    job = await asyncio.to_thread(get_exam_job_status, exam_id)
     
     if not job:
         raise HTTPException(
@@ -87,7 +88,7 @@ async def get_evaluation_status(
             detail=f"No evaluation job found for exam '{exam_id}'"
         )
     
-    return EvaluationJobResponse(**job)
+    return EvaluationJobResponse.model_construct(**job)
 
 
 @router.get("/status/{job_id}", response_model=EvaluationJobResponse)
@@ -101,7 +102,7 @@ async def get_job_status_by_id(
     """
     supabase = get_supabase_client()
     
-    result = supabase.table("evaluation_jobs").select("*").eq("id", job_id).eq("exam_id", exam_id).execute()
+    result = await asyncio.to_thread(supabase.table("evaluation_jobs").select("*").eq("id", job_id).eq("exam_id", exam_id).execute)
     
     if not result.data:
         raise HTTPException(
@@ -109,4 +110,4 @@ async def get_job_status_by_id(
             detail="Evaluation job not found"
         )
     
-    return EvaluationJobResponse(**result.data[0])
+    return EvaluationJobResponse.model_construct(**result.data[0])
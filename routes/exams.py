@@ -1,24 +1,34 @@
 """
 Exam management endpoints.
 """
-from fastapi import APIRouter, Depends, HTTPException, status
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from typing import Optional
 
 from auth import require_role, get_current_user
 from schemas import (
-    ExamCreate, ExamResponse, ExamUpdate, ExamStatus, 
+    ExamCreate, ExamResponse, ExamUpdate, ExamStatus, ExamStatusValue,
     UserProfile, UserRole
 )
 from supabase_client import get_supabase_client
+from cache import get_cached, set_cached, invalidate, check_etag
+from pagination import paginate, set_next_cursor
+from storage import delete_pdfs
+from request_body import json_body, json_body_openapi
 
 
 router = APIRouter(prefix="/exams", tags=["Exams"])
 
 
-@router.post("", response_model=ExamResponse, status_code=status.HTTP_201_CREATED)
+@router.post(
+    "",
+    response_model=ExamResponse,
+    status_code=status.HTTP_201_CREATED,
+    openapi_extra=json_body_openapi(ExamCreate)
+)
 async def create_exam(
-    exam: ExamCreate,
-    user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN))
+    user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN)),
+    exam: ExamCreate = Depends(json_body(ExamCreate))
 ):
     """
     Create a new exam.
@@ -28,7 +38,7 @@ async def create_exam(
     supabase = get_supabase_client()
     
     # Check if exam_id already exists
-    existing = supabase.table("exams").select("id").eq("exam_id", exam.exam_id).execute()
+    existing = await asyncio.to_thread(supabase.table("exams").select("id").eq("exam_id", exam.exam_id).execute)
     if existing.data:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
@@ -36,13 +46,15 @@ async def create_exam(
         )
     
     # Create exam
-    result = supabase.table("exams").insert({
-        "exam_id": exam.exam_id,
-        "name": exam.name,
-        "description": exam.description,
-        "created_by": user.id,
-        "status": ExamStatus.DRAFT.value
-    }).execute()
+    result = await asyncio.to_thread(
+        supabase.table("exams").insert({
+            "exam_id": exam.exam_id,
+            "name": exam.name,
+            "description": exam.description,
+            "created_by": user.id,
+            "status": ExamStatus.DRAFT.value
+        }).execute
+    )
     
     if not result.data:
         raise HTTPException(
@@ -50,34 +62,52 @@ async def create_exam(
             detail="Failed to create exam"
         )
     
-    return ExamResponse(**result.data[0])
+    invalidate("exams", exam.exam_id)
+    
+    return ExamResponse.model_construct(**result.data[0])
 
 
 @router.get("", response_model=list[ExamResponse])
 async def list_exams(
-    status_filter: Optional[ExamStatus] = None,
+    response: Response,
+    status_filter: Optional[ExamStatusValue] = None,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
     user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN))
 ):
     """
-    List all exams.
+    List exams, newest first.
     
-    Optionally filter by status.
+    Optionally filter by status. Results are paginated; pass the
+    X-Next-Cursor response header back as `cursor` to get the next page.
     """
-    supabase = get_supabase_client()
-    
-    query = supabase.table("exams").select("*")
-    
-    if status_filter:
-        query = query.eq("status", status_filter.value)
+    exams = get_cached("exams", None, status_filter, limit, cursor)
+    
+    if exams is None:
+        supabase = get_supabase_client()
+        
+        query = supabase.table("exams").select("*")
+        
+        if status_filter:
+            query = query.eq("status", status_filter)
+        
+        result = await asyncio.to_thread(paginate(query, "created_at", cursor, limit).execute)
+        
+        exams = set_cached(
+            [ExamResponse.model_construct(**exam) for exam in result.data],
+            "exams", None, status_filter, limit, cursor
+        )
     
-    result = query.order("created_at", desc=True).execute()
+    set_next_cursor(response, exams, "created_at", limit)
     
-    return [ExamResponse(**exam) for exam in result.data]
+    return exams
 
 
 @router.get("/{exam_id}", response_model=ExamResponse)
 async def get_exam(
     exam_id: str,
+    request: Request,
+    response: Response,
     user: UserProfile = Depends(require_role(UserRole.STUDENT, UserRole.PROF, UserRole.ADMIN))
 ):
     """
@@ -85,17 +115,27 @@ async def get_exam(
     
     All authenticated users can view exam details.
     """
-    supabase = get_supabase_client()
-    
-    result = supabase.table("exams").select("*").eq("exam_id", exam_id).execute()
-    
-    if not result.data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Exam '{exam_id}' not found"
-        )
-    
-    return ExamResponse(**result.data[0])
+    exam = get_cached("exams", exam_id)
+    
+    if exam is None:
+        supabase = get_supabase_client()
+        
+        result = await asyncio.to_thread(supabase.table("exams").select("*").eq("exam_id", exam_id).execute)
+        
+        if not result.data:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Exam '{exam_id}' not found"
+            )
+        
+        exam = set_cached(ExamResponse.model_construct(**result.data[0]), "exams", exam_id)
+    
+    # Skip the body entirely if the client already has this version
+    not_modified = check_etag(request, response, exam.id, exam.updated_at)
+    if not_modified:
+        return not_modified
+    
+    return exam
 
 
 @router.patch("/{exam_id}", response_model=ExamResponse)
@@ -111,27 +151,24 @@ async def update_exam(
     """
     supabase = get_supabase_client()
     
-    # Check exam exists
-    existing = supabase.table("exams").select("*").eq("exam_id", exam_id).execute()
-    if not existing.data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Exam '{exam_id}' not found"
-        )
-    
     # Build update dict with only provided fields
     update_data = {k: v for k, v in updates.model_dump().items() if v is not None}
     
-    if not update_data:
-        return ExamResponse(**existing.data[0])
+    if update_data:
+        # Update directly; no returned row means the exam doesn't exist
+        result = await asyncio.to_thread(supabase.table("exams").update(update_data).eq("exam_id", exam_id).execute)
+    else:
+        result = await asyncio.to_thread(supabase.table("exams").select("*").eq("exam_id", exam_id).execute)
     
-    # Convert enum to value
-    if "status" in update_data:
-        update_data["status"] = update_data["status"].value
+    if not result.data:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Exam '{exam_id}' not found"
+        )
     
-    result = supabase.table("exams").update(update_data).eq("exam_id", exam_id).execute()
+    invalidate("exams", exam_id)
     
-    return ExamResponse(**result.data[0])
+    return ExamResponse.model_construct(**result.data[0])
 
 
 @router.delete("/{exam_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -146,12 +183,20 @@ async def delete_exam(
     """
     supabase = get_supabase_client()
     
-    # Check exam exists
-    existing = supabase.table("exams").select("id").eq("exam_id", exam_id).execute()
-    if not existing.data:
+    # The cascade removes the answer sheet rows, so note their files first
+    sheets = await asyncio.to_thread(supabase.table("answer_sheets").select("file_path").eq("exam_id", exam_id).execute)
+    
+    # Delete and check the returned rows instead of checking existence first
+    deleted = await asyncio.to_thread(supabase.table("exams").delete().eq("exam_id", exam_id).execute)
+    if not deleted.data:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Exam '{exam_id}' not found"
         )
     
-    supabase.table("exams").delete().eq("exam_id", exam_id).execute()
+    # Remove the exam's PDFs from storage in one request
+    await delete_pdfs([sheet["file_path"] for sheet in sheets.data])
+    
+    # Related rows are gone too, so drop everything cached for the exam
+    for table in ("exams", "answer_keys", "answer_sheets"):
+        invalidate(table, exam_id)
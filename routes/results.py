@@ -1,8 +1,12 @@
 """
 Results management endpoints.
 """
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import Optional
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Optional
+import orjson
+from postgrest.exceptions import APIError
 
 from auth import require_role, get_current_user
 from schemas import (
@@ -10,20 +14,33 @@ from schemas import (
     IllegalFlagResponse, IllegalFlagResolve,
     UserProfile, UserRole
 )
-from supabase_client import get_supabase_client
+from supabase_client import get_supabase_client, NO_DATA_FOUND
+from cache import check_etag
+from request_body import json_body, json_body_openapi
 
 
 router = APIRouter(prefix="/exams/{exam_id}/results", tags=["Results"])
 
+# Columns included in the export, computed once. updated_at is left out
+# as exports are a snapshot.
+EXPORT_COLUMNS = ",".join(field for field in ResultResponse.model_fields if field != "updated_at")
+
+# Rows fetched per round trip while streaming an export
+EXPORT_BATCH_SIZE = 500
+
 
 @router.get("", response_model=ResultsSummary)
 async def get_all_results(
     exam_id: str,
     pending_review_only: bool = False,
+    limit: int = Query(500, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
     user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN))
 ):
     """
-    Get all results for an exam with summary statistics.
+    Get a page of results for an exam with summary statistics.
+    
+    The statistics always cover every matching result, not just the page.
     """
     supabase = get_supabase_client()
     
@@ -32,32 +49,77 @@ async def get_all_results(
     if pending_review_only:
         query = query.eq("has_illegible", True).eq("reviewed", False)
     
-    result = query.order("student_id").execute()
-    
-    results = [ResultResponse(**r) for r in result.data]
-    
-    # Calculate summary stats
-    total_students = len(results)
-    evaluated_students = len([r for r in results if not r.has_illegible or r.reviewed])
-    pending_review = len([r for r in results if r.has_illegible and not r.reviewed])
+    page_query = query.order("student_id").range(offset, offset + limit - 1)
     
-    total_marks_sum = sum(r.total_marks or 0 for r in results if r.total_marks is not None)
-    average_marks = total_marks_sum / total_students if total_students > 0 else None
+    # Aggregates are computed by Postgres (see exam_results_summary in
+    # sql/migrations.sql) while the page of rows is fetched alongside
+    summary, result = await asyncio.gather(
+        asyncio.to_thread(
+            supabase.rpc("exam_results_summary", {
+                "p_exam_id": exam_id,
+                "p_pending_review_only": pending_review_only
+            }).execute
+        ),
+        asyncio.to_thread(page_query.execute)
+    )
+    stats = summary.data
     
-    return ResultsSummary(
+    # Rows come straight from our own table, so skip re-validating them
+    return ResultsSummary.model_construct(
         exam_id=exam_id,
-        total_students=total_students,
-        evaluated_students=evaluated_students,
-        pending_review=pending_review,
-        average_marks=average_marks,
-        results=results
+        total_students=stats["total_students"],
+        evaluated_students=stats["evaluated_students"],
+        pending_review=stats["pending_review"],
+        average_marks=stats["average_marks"],
+        results=[ResultResponse.model_construct(**r) for r in result.data]
     )
 
 
+@router.get("/export", response_class=StreamingResponse)
+async def export_results(
+    exam_id: str,
+    pending_review_only: bool = False,
+    user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN))
+):
+    """
+    Export every result for an exam as newline-delimited JSON.
+    
+    One result per line, ordered by student ID, with null fields left
+    out. Rows are streamed in batches as they are fetched, so clients can
+    process them as they arrive.
+    """
+    supabase = get_supabase_client()
+    
+    async def lines() -> AsyncIterator[bytes]:
+        last_student_id = None
+        while True:
+            query = supabase.table("results").select(EXPORT_COLUMNS).eq("exam_id", exam_id)
+            if pending_review_only:
+                query = query.eq("has_illegible", True).eq("reviewed", False)
+            if last_student_id is not None:
+                query = query.gt("student_id", last_student_id)
+            
+            result = await asyncio.to_thread(query.order("student_id").limit(EXPORT_BATCH_SIZE).execute)
+            
+            # Rows come straight from our own table, so dump them as-is
+            yield b"".join(
+                orjson.dumps({k: v for k, v in row.items() if v is not None}) + b"\n"
+                for row in result.data
+            )
+            
+            if len(result.data) < EXPORT_BATCH_SIZE:
+                return
+            last_student_id = result.data[-1]["student_id"]
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 @router.get("/{student_id}", response_model=ResultResponse)
 async def get_student_result(
     exam_id: str,
     student_id: str,
+    request: Request,
+    response: Response,
     user: UserProfile = Depends(get_current_user)
 ):
     """
@@ -76,7 +138,7 @@ async def get_student_result(
                 detail="You can only view your own results"
             )
     
-    result = supabase.table("results").select("*").eq("exam_id", exam_id).eq("student_id", student_id).execute()
+    result = await asyncio.to_thread(supabase.table("results").select("*").eq("exam_id", exam_id).eq("student_id", student_id).execute)
     
     if not result.data:
         raise HTTPException(
@@ -84,15 +146,26 @@ async def get_student_result(
             detail=f"Result not found for student '{student_id}' in exam '{exam_id}'"
         )
     
-    return ResultResponse(**result.data[0])
+    row = result.data[0]
+    
+    # Skip validation and the body entirely if the client already has this version
+    not_modified = check_etag(request, response, row["id"], row["updated_at"])
+    if not_modified:
+        return not_modified
+    
+    return ResultResponse.model_construct(**row)
 
 
-@router.patch("/{student_id}", response_model=ResultResponse)
+@router.patch(
+    "/{student_id}",
+    response_model=ResultResponse,
+    openapi_extra=json_body_openapi(ResultUpdate)
+)
 async def update_result(
     exam_id: str,
     student_id: str,
-    updates: ResultUpdate,
-    user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN))
+    user: UserProfile = Depends(require_role(UserRole.PROF, UserRole.ADMIN)),
+    updates: ResultUpdate = Depends(json_body(ResultUpdate))
 ):
     """
     Update a student's result (professor override).
@@ -104,49 +177,42 @@ async def update_result(
     """
     supabase = get_supabase_client()
     
-    # Check result exists
-    existing = supabase.table("results").select("*").eq("exam_id", exam_id).eq("student_id", student_id).execute()
+    if not updates.breakdown and updates.reviewed is None:
+        existing = await asyncio.to_thread(supabase.table("results").select("*").eq("exam_id", exam_id).eq("student_id", student_id).execute)
+        if not existing.data:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Result not found for student '{student_id}'"
+            )
+        return ResultResponse.model_construct(**existing.data[0])
     
-    if not existing.data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Result not found for student '{student_id}'"
+    # Store every key, as the evaluator does, even if the client left
+    # the optional ones out
+    breakdown_patch = {
+        qid: {"awarded": None, "illegible": False, **question_update}
+        for qid, question_update in (updates.breakdown or {}).items()
+    }
+    
+    # Merge the patch, recompute totals and set reviewed in one call
+    # (see update_result_breakdown in sql/migrations.sql)
+    try:
+        result = await asyncio.to_thread(
+            supabase.rpc("update_result_breakdown", {
+                "p_exam_id": exam_id,
+                "p_student_id": student_id,
+                "p_breakdown_patch": breakdown_patch,
+                "p_reviewed": updates.reviewed
+            }).execute
         )
+    except APIError as e:
+        if e.code == NO_DATA_FOUND:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Result not found for student '{student_id}'"
+            )
+        raise
     
-    current_result = existing.data[0]
-    update_data = {}
-    
-    # Update breakdown if provided
-    if updates.breakdown:
-        new_breakdown = current_result["breakdown"].copy()
-        
-        for qid, question_update in updates.breakdown.items():
-            new_breakdown[qid] = question_update.model_dump()
-        
-        update_data["breakdown"] = new_breakdown
-        
-        # Recalculate total marks
-        total_marks = 0.0
-        has_illegible = False
-        for qid, breakdown in new_breakdown.items():
-            if breakdown.get("illegible"):
-                has_illegible = True
-            elif breakdown.get("awarded") is not None:
-                total_marks += breakdown["awarded"]
-        
-        update_data["total_marks"] = total_marks
-        update_data["has_illegible"] = has_illegible
-    
-    # Update reviewed status
-    if updates.reviewed is not None:
-        update_data["reviewed"] = updates.reviewed
-    
-    if not update_data:
-        return ResultResponse(**current_result)
-    
-    result = supabase.table("results").update(update_data).eq("exam_id", exam_id).eq("student_id", student_id).execute()
-    
-    return ResultResponse(**result.data[0])
+    return ResultResponse.model_construct(**result.data)
 
 
 # ============== Illegible Flags Routes ==============
@@ -162,9 +228,9 @@ async def get_illegible_flags(
     """
     supabase = get_supabase_client()
     
-    result = supabase.table("illegible_flags").select("*").eq("exam_id", exam_id).eq("student_id", student_id).execute()
+    result = await asyncio.to_thread(supabase.table("illegible_flags").select("*").eq("exam_id", exam_id).eq("student_id", student_id).execute)
     
-    return [IllegalFlagResponse(**flag) for flag in result.data]
+    return [IllegalFlagResponse.model_construct(**flag) for flag in result.data]
 
 
 @router.patch("/{student_id}/illegible/{question_id}", response_model=IllegalFlagResponse)
@@ -179,50 +245,25 @@ async def resolve_illegible_flag(
     Resolve an illegible flag by manually assigning marks.
     """
     supabase = get_supabase_client()
-    from datetime import datetime
     
-    # Find the flag
-    flag_result = supabase.table("illegible_flags").select("*").eq("exam_id", exam_id).eq("student_id", student_id).eq("question_id", question_id).execute()
-    
-    if not flag_result.data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Illegible flag not found for question '{question_id}'"
+    # Resolve the flag and grade the answer on the result in one call
+    # (see resolve_flag in sql/migrations.sql)
+    try:
+        resolved_flag = await asyncio.to_thread(
+            supabase.rpc("resolve_flag", {
+                "p_exam_id": exam_id,
+                "p_student_id": student_id,
+                "p_question_id": question_id,
+                "p_marks": resolution.marks,
+                "p_user_id": user.id
+            }).execute
         )
+    except APIError as e:
+        if e.code == NO_DATA_FOUND:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Illegible flag not found for question '{question_id}'"
+            )
+        raise
     
-    flag = flag_result.data[0]
-    
-    # Update the flag
-    updated_flag = supabase.table("illegible_flags").update({
-        "resolved": True,
-        "resolved_by": user.id,
-        "resolved_marks": resolution.marks,
-        "resolved_at": datetime.utcnow().isoformat()
-    }).eq("id", flag["id"]).execute()
-    
-    # Update the result breakdown
-    result_data = supabase.table("results").select("*").eq("exam_id", exam_id).eq("student_id", student_id).execute()
-    
-    if result_data.data:
-        current_result = result_data.data[0]
-        breakdown = current_result["breakdown"]
-        
-        if question_id in breakdown:
-            breakdown[question_id]["awarded"] = resolution.marks
-            breakdown[question_id]["illegible"] = False
-            breakdown[question_id]["justification"] = f"Manually graded by professor. Original: {breakdown[question_id].get('justification', 'N/A')}"
-        
-        # Recalculate totals
-        total_marks = sum(
-            q.get("awarded", 0) for q in breakdown.values() 
-            if q.get("awarded") is not None and not q.get("illegible")
-        )
-        has_illegible = any(q.get("illegible", False) for q in breakdown.values())
-        
-        supabase.table("results").update({
-            "breakdown": breakdown,
-            "total_marks": total_marks,
-            "has_illegible": has_illegible
-        }).eq("exam_id", exam_id).eq("student_id", student_id).execute()
-    
-    return IllegalFlagResponse(**updated_flag.data[0])
+    return IllegalFlagResponse.model_construct(**resolved_flag.data)
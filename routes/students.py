@@ -1,11 +1,14 @@
 """
 Student management endpoints.
 """
+import asyncio
 from fastapi import APIRouter, Depends, HTTPException, status
+from postgrest.exceptions import APIError
 
 from auth import require_role
 from schemas import StudentResponse, StudentUpdate, UserProfile, UserRole
-from supabase_client import get_supabase_client
+from supabase_client import get_supabase_client, NO_DATA_FOUND
+from cache import get_cached, set_cached, invalidate
 
 
 router = APIRouter(prefix="/exams/{exam_id}/students", tags=["Students"])
@@ -19,30 +22,27 @@ async def list_students(
     """
     List all students who have submitted answer sheets for an exam.
     """
-    supabase = get_supabase_client()
+    cached = get_cached("answer_sheets", exam_id, "students")
+    if cached is not None:
+        return cached
     
-    # Check exam exists
-    exam_result = supabase.table("exams").select("id").eq("exam_id", exam_id).execute()
-    if not exam_result.data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Exam '{exam_id}' not found"
-        )
+    supabase = get_supabase_client()
     
-    # Get all answer sheets with student IDs
-    result = supabase.table("answer_sheets").select("student_id, exam_id, file_name, processed").eq("exam_id", exam_id).execute()
+    # Check the exam exists and fetch its identified answer sheets in one
+    # call (see list_exam_students in sql/migrations.sql)
+    try:
+        result = await asyncio.to_thread(supabase.rpc("list_exam_students", {"p_exam_id": exam_id}).execute)
+    except APIError as e:
+        if e.code == NO_DATA_FOUND:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Exam '{exam_id}' not found"
+            )
+        raise
     
-    students = []
-    for sheet in result.data:
-        if sheet.get("student_id"):
-            students.append(StudentResponse(
-                student_id=sheet["student_id"],
-                exam_id=sheet["exam_id"],
-                file_name=sheet["file_name"],
-                processed=sheet["processed"]
-            ))
+    students = [StudentResponse.model_construct(**sheet) for sheet in result.data]
     
-    return students
+    return set_cached(students, "answer_sheets", exam_id, "students")
 
 
 @router.get("/{student_id}", response_model=StudentResponse)
@@ -56,7 +56,7 @@ async def get_student(
     """
     supabase = get_supabase_client()
     
-    result = supabase.table("answer_sheets").select("*").eq("exam_id", exam_id).eq("student_id", student_id).execute()
+    result = await asyncio.to_thread(supabase.table("answer_sheets").select("student_id, exam_id, file_name, processed").eq("exam_id", exam_id).eq("student_id", student_id).execute)
     
     if not result.data:
         raise HTTPException(
@@ -65,7 +65,7 @@ async def get_student(
         )
     
     sheet = result.data[0]
-    return StudentResponse(
+    return StudentResponse.model_construct(
         student_id=sheet["student_id"],
         exam_id=sheet["exam_id"],
         file_name=sheet["file_name"],
@@ -87,39 +87,29 @@ async def update_student(
     """
     supabase = get_supabase_client()
     
-    # Find the answer sheet
-    existing = supabase.table("answer_sheets").select("*").eq("exam_id", exam_id).eq("student_id", student_id).execute()
-    
-    if not existing.data:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Student '{student_id}' not found in exam '{exam_id}'"
+    # Rename the student on the answer sheet, result and illegible flags in
+    # one transaction (see rename_student in sql/migrations.sql)
+    try:
+        updated = await asyncio.to_thread(
+            supabase.rpc("rename_student", {
+                "p_exam_id": exam_id,
+                "p_old_student_id": student_id,
+                "p_new_student_id": updates.student_id or student_id
+            }).execute
         )
+    except APIError as e:
+        if e.code == NO_DATA_FOUND:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Student '{student_id}' not found in exam '{exam_id}'"
+            )
+        raise
     
-    sheet_id = existing.data[0]["id"]
-    old_student_id = existing.data[0]["student_id"]
-    new_student_id = updates.student_id or old_student_id
+    invalidate("answer_sheets", exam_id)
     
-    # Update answer sheet
-    supabase.table("answer_sheets").update({
-        "student_id": new_student_id
-    }).eq("id", sheet_id).execute()
-    
-    # Also update results if they exist
-    if new_student_id != old_student_id:
-        supabase.table("results").update({
-            "student_id": new_student_id
-        }).eq("exam_id", exam_id).eq("student_id", old_student_id).execute()
-        
-        supabase.table("illegible_flags").update({
-            "student_id": new_student_id
-        }).eq("exam_id", exam_id).eq("student_id", old_student_id).execute()
-    
-    # Get updated data
-    result = supabase.table("answer_sheets").select("*").eq("id", sheet_id).execute()
-    sheet = result.data[0]
+    sheet = updated.data
     
-    return StudentResponse(
+    return StudentResponse.model_construct(
         student_id=sheet["student_id"],
         exam_id=sheet["exam_id"],
         file_name=sheet["file_name"],
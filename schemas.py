@@ -1,20 +1,46 @@
 """
 Pydantic schemas for request/response validation.
 """
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import (
+    BaseModel, ConfigDict, Discriminator, Field, PlainSerializer, Tag,
+    TypeAdapter, WithJsonSchema, field_serializer
+)
+from typing import Annotated, Any, Literal, Optional, Union
+from typing_extensions import NotRequired, TypedDict
 from datetime import datetime
 from enum import Enum
 
 
+def _serialize_timestamp(value: Union[datetime, str]) -> str:
+    return value if isinstance(value, str) else value.isoformat()
+
+
+# Responses are built from trusted DB rows with model_construct, which
+# leaves timestamps as the ISO strings Postgres sent. This lets them
+# serialize in either form without a type-mismatch warning.
+Timestamp = Annotated[
+    datetime,
+    PlainSerializer(_serialize_timestamp, return_type=str, when_used="json"),
+    WithJsonSchema({"type": "string", "format": "date-time"})
+]
+
+
 # ============== ENUMS ==============
 
+# Model fields are annotated with the Literal aliases, which pydantic-core
+# validates with a plain string match instead of an Enum lookup. The Enum
+# classes stay as named constants for call sites; being str Enums, their
+# members compare equal to the Literal values.
+
 class UserRole(str, Enum):
     STUDENT = "student"
     PROF = "prof"
     ADMIN = "admin"
 
 
+UserRoleValue = Literal["student", "prof", "admin"]
+
+
 class ExamStatus(str, Enum):
     DRAFT = "draft"
     READY = "ready"
@@ -22,6 +48,9 @@ class ExamStatus(str, Enum):
     COMPLETED = "completed"
 
 
+ExamStatusValue = Literal["draft", "ready", "evaluating", "completed"]
+
+
 class EvaluationJobStatus(str, Enum):
     PENDING = "pending"
     IN_PROGRESS = "in_progress"
@@ -29,16 +58,23 @@ class EvaluationJobStatus(str, Enum):
     FAILED = "failed"
 
 
+EvaluationJobStatusValue = Literal["pending", "in_progress", "completed", "failed"]
+
+
 # ============== ANSWER KEY SCHEMAS ==============
 
 class RubricItem(BaseModel):
     """A single rubric point with marks."""
+    model_config = ConfigDict(frozen=True)
+    
     point: str = Field(..., description="Description of what to look for")
     marks: float = Field(..., ge=0, description="Marks for this rubric point")
 
 
 class Question(BaseModel):
     """A question in the answer key."""
+    model_config = ConfigDict(frozen=True)
+    
     qid: str = Field(..., description="Question ID like Q1, Q2")
     max_marks: float = Field(..., ge=0, description="Maximum marks for this question")
     rubric: list[RubricItem] = Field(..., description="List of rubric points")
@@ -50,13 +86,18 @@ class AnswerKeyCreate(BaseModel):
     questions: list[Question] = Field(..., description="List of questions with rubrics")
 
 
+# Built once at import so loading an answer key validates the whole
+# questions list in a single pydantic-core call
+QUESTIONS_ADAPTER = TypeAdapter(tuple[Question, ...])
+
+
 class AnswerKeyResponse(BaseModel):
     """Response schema for answer key."""
     id: str
     exam_id: str
     questions: list[Question]
-    created_at: datetime
-    updated_at: datetime
+    created_at: Timestamp
+    updated_at: Timestamp
 
 
 # ============== EXAM SCHEMAS ==============
@@ -75,16 +116,16 @@ class ExamResponse(BaseModel):
     name: str
     description: Optional[str]
     created_by: Optional[str]
-    status: ExamStatus
-    created_at: datetime
-    updated_at: datetime
+    status: ExamStatusValue
+    created_at: Timestamp
+    updated_at: Timestamp
 
 
 class ExamUpdate(BaseModel):
     """Request schema for updating an exam."""
     name: Optional[str] = None
     description: Optional[str] = None
-    status: Optional[ExamStatus] = None
+    status: Optional[ExamStatusValue] = None
 
 
 # ============== ANSWER SHEET SCHEMAS ==============
@@ -96,8 +137,9 @@ class AnswerSheetResponse(BaseModel):
     student_id: Optional[str]
     file_path: str
     file_name: str
-    uploaded_at: datetime
+    uploaded_at: Timestamp
     processed: bool
+    url: Optional[str] = Field(None, description="Signed URL, only set when listing with include_urls")
 
 
 # ============== STUDENT SCHEMAS ==============
@@ -121,31 +163,60 @@ class EvaluationJobResponse(BaseModel):
     """Response schema for evaluation job status."""
     id: str
     exam_id: str
-    status: EvaluationJobStatus
+    status: EvaluationJobStatusValue
     total_sheets: int
     processed_sheets: int
-    started_at: Optional[datetime]
-    completed_at: Optional[datetime]
+    started_at: Optional[Timestamp]
+    completed_at: Optional[Timestamp]
     error_message: Optional[str]
-    created_at: datetime
+    created_at: Timestamp
 
 
 class EvaluationStartResponse(BaseModel):
     """Response when starting an evaluation."""
     message: str
     job_id: str
-    status: EvaluationJobStatus
+    status: EvaluationJobStatusValue
 
 
 # ============== RESULT SCHEMAS ==============
 
-class QuestionBreakdown(BaseModel):
-    """Breakdown of marks for a single question."""
-    awarded: Optional[float] = Field(None, description="Marks awarded, null if illegible")
-    max: float = Field(..., description="Maximum marks")
-    justification: str = Field(..., description="Explanation of grading")
-    confidence: float = Field(..., ge=0, le=1, description="AI confidence score")
-    illegible: bool = Field(default=False, description="Whether answer was illegible")
+# TypedDicts rather than models: one sits under every question of every
+# result, and plain dicts validate and serialize without per-item model
+# overhead.
+class _BreakdownBase(TypedDict):
+    max: Annotated[float, Field(description="Maximum marks")]
+    justification: Annotated[str, Field(description="Explanation of grading")]
+    confidence: Annotated[float, Field(ge=0, le=1, description="AI confidence score")]
+
+
+class LegibleBreakdown(_BreakdownBase):
+    """Breakdown of marks for a graded question."""
+    awarded: Annotated[float, Field(description="Marks awarded")]
+    illegible: NotRequired[Literal[False]]
+
+
+class IllegibleBreakdown(_BreakdownBase):
+    """Breakdown for a question that couldn't be read, pending review."""
+    awarded: NotRequired[None]
+    illegible: Literal[True]
+
+
+def _breakdown_tag(value: Any) -> Optional[str]:
+    """Pick the breakdown variant from the illegible flag, which defaults to False."""
+    if isinstance(value, dict):
+        return "illegible" if value.get("illegible") else "legible"
+    return None
+
+
+# Tagged on illegible, so validation goes straight to the matching variant
+QuestionBreakdown = Annotated[
+    Union[
+        Annotated[LegibleBreakdown, Tag("legible")],
+        Annotated[IllegibleBreakdown, Tag("illegible")]
+    ],
+    Discriminator(_breakdown_tag)
+]
 
 
 class ResultResponse(BaseModel):
@@ -158,8 +229,16 @@ class ResultResponse(BaseModel):
     breakdown: dict[str, QuestionBreakdown]
     has_illegible: bool
     reviewed: bool
-    created_at: datetime
-    updated_at: datetime
+    created_at: Timestamp
+    updated_at: Timestamp
+    
+    # The stored breakdown is already in shape, but Postgres hands back
+    # whole-number marks as ints, which the tagged union's serializer
+    # would flag. Pass it through as-is; leaving the return type
+    # unannotated keeps the documented schema.
+    @field_serializer("breakdown", when_used="json")
+    def _serialize_breakdown(self, breakdown: dict):
+        return breakdown
 
 
 class ResultUpdate(BaseModel):
@@ -191,8 +270,8 @@ class IllegalFlagResponse(BaseModel):
     resolved: bool
     resolved_by: Optional[str]
     resolved_marks: Optional[float]
-    resolved_at: Optional[datetime]
-    created_at: datetime
+    resolved_at: Optional[Timestamp]
+    created_at: Timestamp
 
 
 class IllegalFlagResolve(BaseModel):
@@ -204,15 +283,19 @@ class IllegalFlagResolve(BaseModel):
 
 class UserProfile(BaseModel):
     """User profile from Supabase auth."""
+    model_config = ConfigDict(frozen=True)
+    
     id: str
     email: Optional[str]
     full_name: Optional[str]
-    role: UserRole
+    role: UserRoleValue
     student_id: Optional[str]
 
 
 class TokenPayload(BaseModel):
     """JWT token payload."""
+    model_config = ConfigDict(frozen=True)
+    
     sub: str  # User ID
     email: Optional[str]
     role: Optional[str]
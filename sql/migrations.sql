@@ -204,6 +204,254 @@ CREATE TRIGGER update_answer_keys_updated_at
     BEFORE UPDATE ON public.answer_keys 
     FOR EACH ROW EXECUTE FUNCTION update_updated_at();
 
+-- =============================================
+-- RPC FUNCTIONS
+-- =============================================
+
+-- Persist one evaluated answer sheet in a single round trip:
+-- upsert the result, flag illegible answers and mark the sheet processed.
+-- Job progress is flushed separately by the evaluator every few sheets.
+CREATE OR REPLACE FUNCTION public.evaluate_sheet_commit(
+    p_exam_id TEXT,
+    p_student_id TEXT,
+    p_total_marks DECIMAL,
+    p_max_marks DECIMAL,
+    p_breakdown JSONB,
+    p_has_illegible BOOLEAN,
+    p_illegible_questions JSONB,
+    p_file_path TEXT,
+    p_sheet_id UUID
+)
+RETURNS UUID AS $$
+DECLARE
+    v_result_id UUID;
+BEGIN
+    INSERT INTO public.results (exam_id, student_id, total_marks, max_marks, breakdown, has_illegible, reviewed)
+    VALUES (p_exam_id, p_student_id, p_total_marks, p_max_marks, p_breakdown, p_has_illegible, FALSE)
+    ON CONFLICT (exam_id, student_id) DO UPDATE SET
+        total_marks = EXCLUDED.total_marks,
+        max_marks = EXCLUDED.max_marks,
+        breakdown = EXCLUDED.breakdown,
+        has_illegible = EXCLUDED.has_illegible,
+        reviewed = EXCLUDED.reviewed
+    RETURNING id INTO v_result_id;
+
+    IF p_has_illegible THEN
+        INSERT INTO public.illegible_flags (result_id, exam_id, student_id, question_id, original_answer_path)
+        SELECT v_result_id, p_exam_id, p_student_id, q.question_id, p_file_path
+        FROM jsonb_array_elements_text(p_illegible_questions) AS q(question_id);
+    END IF;
+
+    UPDATE public.answer_sheets
+    SET student_id = p_student_id, processed = TRUE
+    WHERE id = p_sheet_id;
+
+    RETURN v_result_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Create or replace an exam's answer key and move the exam from draft
+-- to ready in one round trip. A missing exam surfaces as a foreign key
+-- violation (23503) from the insert.
+CREATE OR REPLACE FUNCTION public.save_answer_key(
+    p_exam_id TEXT,
+    p_questions JSONB
+)
+RETURNS public.answer_keys AS $$
+DECLARE
+    v_answer_key public.answer_keys;
+BEGIN
+    INSERT INTO public.answer_keys (exam_id, questions)
+    VALUES (p_exam_id, p_questions)
+    ON CONFLICT (exam_id) DO UPDATE SET questions = EXCLUDED.questions
+    RETURNING * INTO v_answer_key;
+
+    UPDATE public.exams
+    SET status = 'ready'
+    WHERE exam_id = p_exam_id AND status = 'draft';
+
+    RETURN v_answer_key;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Summary statistics for an exam's results, computed in one scan so the
+-- API doesn't have to download every row to count them.
+CREATE OR REPLACE FUNCTION public.exam_results_summary(
+    p_exam_id TEXT,
+    p_pending_review_only BOOLEAN DEFAULT FALSE
+)
+RETURNS JSONB AS $$
+    SELECT jsonb_build_object(
+        'total_students', COUNT(*),
+        'evaluated_students', COUNT(*) FILTER (WHERE NOT has_illegible OR reviewed),
+        'pending_review', COUNT(*) FILTER (WHERE has_illegible AND NOT reviewed),
+        'average_marks', COALESCE(SUM(total_marks), 0) / NULLIF(COUNT(*), 0)
+    )
+    FROM public.results
+    WHERE exam_id = p_exam_id
+      AND (NOT p_pending_review_only OR (has_illegible AND NOT reviewed));
+$$ LANGUAGE sql STABLE;
+
+-- Total awarded marks (skipping illegible answers) and whether any answer
+-- is still illegible, from a single scan of a result breakdown.
+CREATE OR REPLACE FUNCTION public.breakdown_totals(p_breakdown JSONB)
+RETURNS TABLE (total_marks DECIMAL, has_illegible BOOLEAN) AS $$
+    SELECT
+        COALESCE(SUM((q.value->>'awarded')::DECIMAL)
+            FILTER (WHERE NOT COALESCE((q.value->>'illegible')::BOOLEAN, FALSE)), 0),
+        COALESCE(BOOL_OR(COALESCE((q.value->>'illegible')::BOOLEAN, FALSE)), FALSE)
+    FROM jsonb_each(p_breakdown) AS q;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Apply a professor's override to a result in one statement: merge the
+-- per-question patch into the breakdown, recompute the totals from the
+-- merged breakdown and optionally set the reviewed flag. Raises
+-- no_data_found (P0002) if the result doesn't exist.
+CREATE OR REPLACE FUNCTION public.update_result_breakdown(
+    p_exam_id TEXT,
+    p_student_id TEXT,
+    p_breakdown_patch JSONB,
+    p_reviewed BOOLEAN DEFAULT NULL
+)
+RETURNS public.results AS $$
+DECLARE
+    v_result public.results;
+BEGIN
+    -- Merge against the row being updated, so a concurrent patch that
+    -- commits first is re-read rather than overwritten, and scan the
+    -- merged breakdown once for both totals
+    UPDATE public.results AS r
+    SET (breakdown, total_marks, has_illegible) = (
+            SELECT
+                merged.breakdown,
+                CASE WHEN p_breakdown_patch = '{}'::JSONB THEN r.total_marks
+                    ELSE totals.total_marks END,
+                CASE WHEN p_breakdown_patch = '{}'::JSONB THEN r.has_illegible
+                    ELSE totals.has_illegible END
+            FROM (SELECT r.breakdown || p_breakdown_patch AS breakdown) AS merged,
+            LATERAL public.breakdown_totals(merged.breakdown) AS totals
+        ),
+        reviewed = COALESCE(p_reviewed, r.reviewed)
+    WHERE r.exam_id = p_exam_id AND r.student_id = p_student_id
+    RETURNING r.* INTO v_result;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Result not found' USING ERRCODE = 'no_data_found';
+    END IF;
+
+    RETURN v_result;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Resolve an illegible flag and grade the answer on the result in one
+-- transaction. A question can have duplicate flags (one per upsert of the
+-- student's result), so all of them are resolved and the latest returned.
+-- Raises no_data_found (P0002) if the flag doesn't exist.
+CREATE OR REPLACE FUNCTION public.resolve_flag(
+    p_exam_id TEXT,
+    p_student_id TEXT,
+    p_question_id TEXT,
+    p_marks DECIMAL,
+    p_user_id UUID
+)
+RETURNS public.illegible_flags AS $$
+DECLARE
+    v_flag public.illegible_flags;
+BEGIN
+    WITH resolved AS (
+        UPDATE public.illegible_flags
+        SET resolved = TRUE,
+            resolved_by = p_user_id,
+            resolved_marks = p_marks,
+            resolved_at = NOW()
+        WHERE exam_id = p_exam_id AND student_id = p_student_id AND question_id = p_question_id
+        RETURNING *
+    )
+    SELECT * INTO v_flag FROM resolved ORDER BY created_at DESC LIMIT 1;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Illegible flag not found' USING ERRCODE = 'no_data_found';
+    END IF;
+
+    -- Grade against the row being updated so concurrent overrides aren't lost
+    UPDATE public.results AS r
+    SET (breakdown, total_marks, has_illegible) = (
+        SELECT graded.breakdown, totals.total_marks, totals.has_illegible
+        FROM (
+            SELECT CASE WHEN r.breakdown ? p_question_id THEN
+                jsonb_set(r.breakdown, ARRAY[p_question_id], r.breakdown->p_question_id || jsonb_build_object(
+                    'awarded', p_marks,
+                    'illegible', FALSE,
+                    'justification', 'Manually graded by professor. Original: '
+                        || COALESCE(r.breakdown->p_question_id->>'justification', 'N/A')
+                ))
+            ELSE r.breakdown END AS breakdown
+        ) AS graded,
+        LATERAL public.breakdown_totals(graded.breakdown) AS totals
+    )
+    WHERE r.exam_id = p_exam_id AND r.student_id = p_student_id;
+
+    RETURN v_flag;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Students with an identified answer sheet for an exam, in one round trip.
+-- Raises no_data_found (P0002) if the exam doesn't exist.
+CREATE OR REPLACE FUNCTION public.list_exam_students(p_exam_id TEXT)
+RETURNS TABLE (student_id TEXT, exam_id TEXT, file_name TEXT, processed BOOLEAN) AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM public.exams AS e WHERE e.exam_id = p_exam_id) THEN
+        RAISE EXCEPTION 'Exam not found' USING ERRCODE = 'no_data_found';
+    END IF;
+
+    -- <> '' also drops sheets whose student ID is still NULL
+    RETURN QUERY
+    SELECT s.student_id, s.exam_id, s.file_name, s.processed
+    FROM public.answer_sheets AS s
+    WHERE s.exam_id = p_exam_id AND s.student_id <> '';
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Correct a misread student ID on an answer sheet and carry the change over
+-- to the student's result and illegible flags, atomically. Returns the
+-- updated answer sheet; raises no_data_found (P0002) if the student has no
+-- sheet in the exam.
+CREATE OR REPLACE FUNCTION public.rename_student(
+    p_exam_id TEXT,
+    p_old_student_id TEXT,
+    p_new_student_id TEXT
+)
+RETURNS public.answer_sheets AS $$
+DECLARE
+    v_sheet public.answer_sheets;
+BEGIN
+    UPDATE public.answer_sheets
+    SET student_id = p_new_student_id
+    WHERE id = (
+        SELECT id FROM public.answer_sheets
+        WHERE exam_id = p_exam_id AND student_id = p_old_student_id
+        LIMIT 1
+    )
+    RETURNING * INTO v_sheet;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Student not found' USING ERRCODE = 'no_data_found';
+    END IF;
+
+    IF p_new_student_id <> p_old_student_id THEN
+        UPDATE public.results
+        SET student_id = p_new_student_id
+        WHERE exam_id = p_exam_id AND student_id = p_old_student_id;
+
+        UPDATE public.illegible_flags
+        SET student_id = p_new_student_id
+        WHERE exam_id = p_exam_id AND student_id = p_old_student_id;
+    END IF;
+
+    RETURN v_sheet;
+END;
+$$ LANGUAGE plpgsql;
+
 -- =============================================
 -- INDEXES FOR PERFORMANCE
 -- =============================================
@@ -214,3 +462,16 @@ CREATE INDEX IF NOT EXISTS idx_results_exam_id ON public.results(exam_id);
 CREATE INDEX IF NOT EXISTS idx_results_student_id ON public.results(student_id);
 CREATE INDEX IF NOT EXISTS idx_evaluation_jobs_exam_id ON public.evaluation_jobs(exam_id);
 CREATE INDEX IF NOT EXISTS idx_illegible_flags_exam_id ON public.illegible_flags(exam_id);
+
+-- Composite indexes for the multi-column filters used by the API.
+-- results(exam_id, student_id) and exams(exam_id) are already covered by
+-- their UNIQUE constraints.
+-- answer_sheets(exam_id, student_id): get_student, list_exam_students, rename_student
+CREATE INDEX IF NOT EXISTS idx_answer_sheets_exam_student ON public.answer_sheets(exam_id, student_id);
+-- illegible_flags(exam_id, student_id, question_id): get_illegible_flags, resolve_flag
+CREATE INDEX IF NOT EXISTS idx_illegible_flags_exam_student_question ON public.illegible_flags(exam_id, student_id, question_id);
+-- evaluation_jobs(exam_id, created_at DESC): latest job for an exam
+CREATE INDEX IF NOT EXISTS idx_evaluation_jobs_exam_created ON public.evaluation_jobs(exam_id, created_at DESC);
+-- Keyset pagination for list_answer_sheets and list_exams (newest first, id tie-break)
+CREATE INDEX IF NOT EXISTS idx_answer_sheets_exam_uploaded ON public.answer_sheets(exam_id, uploaded_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_exams_created ON public.exams(created_at DESC, id DESC);
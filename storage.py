@@ -2,13 +2,78 @@
 Supabase storage operations for PDF file management.
 """
 from fastapi import UploadFile, HTTPException, status
-from typing import Optional
-import uuid
+from typing import AsyncIterator, BinaryIO, Iterator, Optional
+from urllib.parse import quote
+from storage3.exceptions import StorageApiError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+import asyncio
+import httpx
+import os
 
-from supabase_client import get_supabase_client
+from supabase_client import get_supabase_client, get_http_client, get_async_http_client
 from config import get_settings
 
 
+# Settings and the bucket handle are fixed for the process, so bind them
+# once rather than looking them up on every call
+settings = get_settings()
+bucket = get_supabase_client().storage.from_(settings.STORAGE_BUCKET)
+
+# Chunk sizes used when streaming files to and from storage
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Every PDF starts with this signature
+PDF_MAGIC = b"%PDF-"
+
+
+def _object_url(file_path: str) -> str:
+    """Storage REST URL for an object in the answer sheet bucket."""
+    return f"{settings.SUPABASE_URL}/storage/v1/object/{settings.STORAGE_BUCKET}/{quote(file_path)}"
+
+
+def _auth_headers() -> dict[str, str]:
+    """Headers authenticating a storage REST call with the service key."""
+    return {
+        "Authorization": f"Bearer {settings.SUPABASE_SERVICE_KEY}",
+        "apikey": settings.SUPABASE_SERVICE_KEY,
+    }
+
+
+def _too_large() -> HTTPException:
+    """Build the 413 error for an oversized upload."""
+    return HTTPException(
+        status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+        detail=f"File exceeds the {settings.MAX_UPLOAD_MB} MB upload limit"
+    )
+
+
+def check_upload_size(file: UploadFile):
+    """
+    Reject a file whose known size is over the upload limit.
+    
+    Raises:
+        HTTPException: 413 if the file is too large
+    """
+    if file.size is not None and file.size > settings.MAX_UPLOAD_MB * 1024 * 1024:
+        raise _too_large()
+
+
+def _iter_chunks(file_obj: BinaryIO, max_bytes: int) -> Iterator[bytes]:
+    """
+    Yield a file's content in fixed-size chunks.
+    
+    Raises:
+        HTTPException: 413 as soon as more than max_bytes have been read
+    """
+    total = 0
+    while chunk := file_obj.read(UPLOAD_CHUNK_SIZE):
+        total += len(chunk)
+        if total > max_bytes:
+            raise _too_large()
+        yield chunk
+
+
 async def upload_pdf(
     exam_id: str,
     file: UploadFile,
@@ -25,11 +90,12 @@ async def upload_pdf(
     Returns:
         The storage path of the uploaded file
     """
-    settings = get_settings()
-    supabase = get_supabase_client()
+    # Reject oversized files before sending anything
+    check_upload_size(file)
     
-    # Validate file type
-    if not file.content_type or "pdf" not in file.content_type.lower():
+    # Validate file type by its magic bytes - the client-supplied
+    # content type can't be trusted
+    if await file.read(len(PDF_MAGIC)) != PDF_MAGIC:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Only PDF files are allowed"
@@ -37,23 +103,31 @@ async def upload_pdf(
     
     # Generate unique filename to avoid collisions
     original_name = file.filename or "answer_sheet.pdf"
-    unique_id = str(uuid.uuid4())[:8]
+    unique_id = os.urandom(4).hex()
     filename = custom_filename or f"{unique_id}_{original_name}"
     
     # Storage path: exam_id/filename
     file_path = f"{exam_id}/{filename}"
     
-    # Read file content
-    content = await file.read()
+    # Stream the spooled upload straight to storage instead of reading
+    # the whole PDF into memory first
+    await file.seek(0)
+    headers = {**_auth_headers(), "Content-Type": "application/pdf"}
+    if file.size is not None:
+        headers["Content-Length"] = str(file.size)
     
-    # Upload to Supabase storage
+    # Upload to Supabase storage (sync client, so keep it off the event loop)
     try:
-        result = supabase.storage.from_(settings.STORAGE_BUCKET).upload(
-            path=file_path,
-            file=content,
-            file_options={"content-type": "application/pdf"}
+        response = await asyncio.to_thread(
+            get_http_client().post,
+            _object_url(file_path),
+            content=_iter_chunks(file.file, settings.MAX_UPLOAD_MB * 1024 * 1024),
+            headers=headers
         )
+        response.raise_for_status()
         return file_path
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -61,7 +135,36 @@ async def upload_pdf(
         )
 
 
-def get_pdf_url(file_path: str, expires_in: int = 3600) -> str:
+async def bulk_upload_pdfs(
+    exam_id: str,
+    files: list[UploadFile],
+    concurrency: int = 16
+) -> list:
+    """
+    Upload several PDF files to Supabase storage concurrently.
+    
+    Args:
+        exam_id: The exam ID to organize files under
+        files: The uploaded files
+        concurrency: Max uploads in flight at once
+        
+    Returns:
+        For each file, in order, its storage path or the exception that
+        failed its upload
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def upload_with_limit(file: UploadFile) -> str:
+        async with semaphore:
+            return await upload_pdf(exam_id, file)
+    
+    return await asyncio.gather(
+        *[upload_with_limit(file) for file in files],
+        return_exceptions=True
+    )
+
+
+async def get_pdf_url(file_path: str, expires_in: int = 3600) -> str:
     """
     Get a signed URL for a PDF file.
     
@@ -72,11 +175,9 @@ def get_pdf_url(file_path: str, expires_in: int = 3600) -> str:
     Returns:
         Signed URL for the file
     """
-    settings = get_settings()
-    supabase = get_supabase_client()
-    
     try:
-        result = supabase.storage.from_(settings.STORAGE_BUCKET).create_signed_url(
+        result = await asyncio.to_thread(
+            bucket.create_signed_url,
             path=file_path,
             expires_in=expires_in
         )
@@ -88,7 +189,36 @@ def get_pdf_url(file_path: str, expires_in: int = 3600) -> str:
         )
 
 
-def download_pdf(file_path: str) -> bytes:
+async def get_pdf_urls(file_paths: list[str], expires_in: int = 3600) -> dict[str, str]:
+    """
+    Get signed URLs for several PDF files in one storage request.
+    
+    Args:
+        file_paths: The storage paths of the files
+        expires_in: URL expiration time in seconds (default 1 hour)
+        
+    Returns:
+        Signed URL by storage path. Files storage couldn't sign are left out.
+    """
+    if not file_paths:
+        return {}
+    
+    try:
+        result = await asyncio.to_thread(
+            bucket.create_signed_urls,
+            paths=file_paths,
+            expires_in=expires_in
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get file URLs: {str(e)}"
+        )
+    
+    return {item["path"]: item["signedURL"] for item in result if not item["error"]}
+
+
+async def download_pdf(file_path: str) -> bytes:
     """
     Download a PDF file from storage.
     
@@ -98,11 +228,8 @@ def download_pdf(file_path: str) -> bytes:
     Returns:
         File content as bytes
     """
-    settings = get_settings()
-    supabase = get_supabase_client()
-    
     try:
-        result = supabase.storage.from_(settings.STORAGE_BUCKET).download(file_path)
+        result = await asyncio.to_thread(bucket.download, file_path)
         return result
     except Exception as e:
         raise HTTPException(
@@ -111,7 +238,44 @@ def download_pdf(file_path: str) -> bytes:
         )
 
 
-def list_pdfs(exam_id: str) -> list[dict]:
+async def stream_pdf(file_path: str) -> tuple[AsyncIterator[bytes], httpx.Response]:
+    """
+    Stream a PDF file from storage without holding it in memory.
+    
+    The storage request is made up front, so a missing file raises here
+    rather than partway through a StreamingResponse.
+    
+    Args:
+        file_path: The storage path of the file
+        
+    Returns:
+        Tuple of (async iterator over the file content, the open storage
+        response). The caller must close the response, even if the
+        iterator is never consumed - e.g. as the StreamingResponse's
+        background task.
+    """
+    client = get_async_http_client()
+    
+    try:
+        request = client.build_request("GET", _object_url(file_path), headers=_auth_headers())
+        response = await client.send(request, stream=True)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Failed to download file: {str(e)}"
+        )
+    
+    if response.is_error:
+        await response.aclose()
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Failed to download file: storage returned {response.status_code}"
+        )
+    
+    return response.aiter_bytes(DOWNLOAD_CHUNK_SIZE), response
+
+
+async def list_pdfs(exam_id: str) -> list[dict]:
     """
     List all PDF files for an exam.
     
@@ -121,31 +285,60 @@ def list_pdfs(exam_id: str) -> list[dict]:
     Returns:
         List of file metadata
     """
-    settings = get_settings()
-    supabase = get_supabase_client()
-    
     try:
-        result = supabase.storage.from_(settings.STORAGE_BUCKET).list(exam_id)
+        result = await asyncio.to_thread(bucket.list, exam_id)
         return result
     except Exception as e:
         return []
 
 
-def delete_pdf(file_path: str) -> bool:
+def _is_transient(error: BaseException) -> bool:
+    """Whether a storage call failed in a way worth retrying."""
+    if isinstance(error, httpx.TransportError):
+        return True
+    return isinstance(error, StorageApiError) and str(error.status).startswith("5")
+
+
+@retry(
+    retry=retry_if_exception(_is_transient),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.1, max=1),
+    reraise=True
+)
+def _remove(file_paths: list[str]) -> list[dict]:
+    """Remove files from the bucket, retrying network errors and 5xx responses."""
+    return bucket.remove(file_paths)
+
+
+async def delete_pdfs(file_paths: list[str]) -> list[str]:
     """
-    Delete a PDF file from storage.
+    Delete several PDF files from storage in one request.
     
     Args:
-        file_path: The storage path of the file
+        file_paths: The storage paths of the files
         
     Returns:
-        True if deleted successfully
+        The paths that were deleted. Empty if the delete failed.
     """
-    settings = get_settings()
-    supabase = get_supabase_client()
+    if not file_paths:
+        return []
     
     try:
-        supabase.storage.from_(settings.STORAGE_BUCKET).remove([file_path])
-        return True
+        removed = await asyncio.to_thread(_remove, file_paths)
+        return [obj["name"] for obj in removed]
     except Exception as e:
-        return False
+        print(f"Error deleting {len(file_paths)} files from storage: {e}")
+        return []
+
+
+async def delete_pdf(file_path: str) -> bool:
+    """
+    Delete a PDF file from storage.
+    
+    Args:
+        file_path: The storage path of the file
+        
+    Returns:
+        True if deleted successfully
+    """
+    return bool(await delete_pdfs([file_path]))
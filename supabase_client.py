@@ -1,12 +1,62 @@
 """
 Supabase client singleton for database and storage operations.
 """
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 from functools import lru_cache
+import httpx
+
 from config import get_settings
 
 
-@lru_cache()
+# Postgres error code raised when a write references a missing parent row
+FOREIGN_KEY_VIOLATION = "23503"
+
+# Raised by our RPC functions when the row they should update doesn't exist
+NO_DATA_FOUND = "P0002"
+
+# Pool sizing shared by the sync and async HTTP clients. HTTP/2 lets
+# concurrent requests share a connection, and the pool is sized for the
+# evaluator's fan-out plus request traffic. The timeouts apply per
+# connect/read/write, so large uploads still stream fine.
+HTTP_LIMITS = httpx.Limits(
+    max_connections=256,
+    max_keepalive_connections=128,
+    keepalive_expiry=30
+)
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=2.0)
+
+
+@lru_cache(maxsize=1)
+def get_http_client() -> httpx.Client:
+    """
+    Get the shared HTTP client used by every Supabase client.
+
+    Keeping one pool of keep-alive HTTP/2 connections means requests
+    reuse open TLS connections instead of handshaking per call.
+    """
+    return httpx.Client(
+        limits=HTTP_LIMITS,
+        timeout=HTTP_TIMEOUT,
+        http2=True,
+        follow_redirects=True
+    )
+
+
+@lru_cache(maxsize=1)
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Get the shared async HTTP client, for responses streamed straight
+    through to our own clients.
+    """
+    return httpx.AsyncClient(
+        limits=HTTP_LIMITS,
+        timeout=HTTP_TIMEOUT,
+        http2=True,
+        follow_redirects=True
+    )
+
+
+@lru_cache(maxsize=1)
 def get_supabase_client() -> Client:
     """
     Get cached Supabase client instance.
@@ -15,11 +65,12 @@ def get_supabase_client() -> Client:
     settings = get_settings()
     return create_client(
         settings.SUPABASE_URL,
-        settings.SUPABASE_SERVICE_KEY
+        settings.SUPABASE_SERVICE_KEY,
+        options=ClientOptions(httpx_client=get_http_client())
     )
 
 
-@lru_cache()
+@lru_cache(maxsize=1)
 def get_supabase_anon_client() -> Client:
     """
     Get cached Supabase client with anon key.
@@ -28,7 +79,8 @@ def get_supabase_anon_client() -> Client:
     settings = get_settings()
     return create_client(
         settings.SUPABASE_URL,
-        settings.SUPABASE_ANON_KEY
+        settings.SUPABASE_ANON_KEY,
+        options=ClientOptions(httpx_client=get_http_client())
     )
 
 
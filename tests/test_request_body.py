@@ -0,0 +1,61 @@
+"""
+Auth must be checked before json_body parses the request body.
+"""
+import os
+import unittest
+
+# Settings are read at import time, so provide placeholders before main loads
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("SUPABASE_URL", "http://localhost:1")
+os.environ.setdefault("SUPABASE_ANON_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.x")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.x")
+
+from fastapi.testclient import TestClient
+
+import auth
+import main
+from schemas import UserProfile
+
+
+BAD_BODY = b"{not json"
+
+# Every route that reads its body through json_body
+BODY_ROUTES = [
+    ("POST", "/api/v1/exams"),
+    ("POST", "/api/v1/exams/exam-1/answer-key"),
+    ("PATCH", "/api/v1/exams/exam-1/results/S1"),
+]
+
+
+class AuthBeforeBodyTest(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        main.app.dependency_overrides.clear()
+
+    def send(self, method: str, path: str):
+        return self.client.request(
+            method, path, content=BAD_BODY, headers={"Content-Type": "application/json"}
+        )
+
+    def test_unauthenticated_bad_body_gets_401(self):
+        for method, path in BODY_ROUTES:
+            with self.subTest(path=path):
+                response = self.send(method, path)
+                self.assertEqual(response.status_code, 401)
+
+    def test_student_bad_body_gets_403(self):
+        student = UserProfile(
+            id="user-1", email=None, full_name=None, role="student", student_id="S1"
+        )
+        main.app.dependency_overrides[auth.get_current_user] = lambda: student
+
+        for method, path in BODY_ROUTES:
+            with self.subTest(path=path):
+                response = self.send(method, path)
+                self.assertEqual(response.status_code, 403)
+
+
+if __name__ == "__main__":
+    unittest.main()